@@ -0,0 +1,291 @@
+import argparse
+import json
+import os
+import platform
+import random
+import resource
+import sys
+import time
+import tracemalloc
+from copy import deepcopy
+from cages import *
+from tests import test_cages_data, test_non_cages_data
+
+
+def get_corpus(data=None):
+    return [(position, [get_square(sq) for sq in frozen_squares_strings],
+             [get_square(sq) for sq in additional_zone_squares_strings], depth)
+            for (position, frozen_squares_strings, additional_zone_squares_strings, depth)
+            in (test_cages_data + test_non_cages_data if data is None else data)]
+
+
+# The depth at which the cages of the corpus are searched again, and the generated positions are searched, as harder
+# positions for the suite. A deeper search follows longer retraction sequences before a cage is proven.
+generated_depth = 100
+# Generated positions are kept if they are proven to be cages at generated_depth, without known cages, after
+# visiting at least generated_min_nodes positions and at most generated_max_nodes.
+generated_count = 10
+generated_min_nodes = 2000
+generated_max_nodes = 50000
+
+
+def get_forsythe_string(board):
+    ranks = []
+    for rank in range(7, -1, -1):
+        rank_string, empty_squares = '', 0
+        for file in range(8):
+            color, unit = board[file][rank][:2]
+            if unit == EMPTY:
+                empty_squares += 1
+                continue
+            rank_string += (str(empty_squares) if empty_squares else '') + (unit if color == WHITE else unit.lower())
+            empty_squares = 0
+        ranks.append(rank_string + (str(empty_squares) if empty_squares else ''))
+    return '/'.join(ranks)
+
+
+def get_random_position(rng):
+    # White pawns on the second to fourth ranks of a few neighbouring files, with a few units of either color among
+    # and behind them, at most one king of each color. Most cages of this kind lock pieces behind the pawns.
+    board = [[(EMPTY, EMPTY) for _ in range(8)] for _ in range(8)]
+    width = rng.randint(4, 6)
+    first_file = rng.randrange(0, 9 - width)
+    files = range(first_file, first_file + width)
+    for _ in range(rng.randint(4, 8)):
+        board[rng.choice(files)][rng.choice([1, 1, 2, 2, 3])] = (WHITE, PAWN)
+    for _ in range(rng.randint(2, 4)):
+        file, rank = rng.choice(files), rng.choice([0, 0, 1, 1, 2])
+        color_unit = (rng.choice([WHITE, WHITE, BLACK]), rng.choice([KING, QUEEN, ROOK, BISHOP, KNIGHT]))
+        if board[file][rank][1] == EMPTY and \
+                not (color_unit[1] == KING and any(color_unit in board_file for board_file in board)):
+            board[file][rank] = color_unit
+    return get_forsythe_string(board)
+
+
+def generate_harder_positions(seed=0, count=generated_count):
+    # Draws random positions from a generator with the given seed until count of them are cages that take between
+    # generated_min_nodes and generated_max_nodes positions to prove at generated_depth. Node counts do not depend on
+    # the machine, so the same seed always gives the same positions.
+    rng = random.Random(seed)
+    positions = []
+    while len(positions) < count:
+        position = get_random_position(rng)
+        verifier = CageVerifier(KnownCages(), max_nodes=generated_max_nodes)
+        result, _, _, stats, _ = verifier.verify_position((position, [], [], generated_depth), collect_stats=True)
+        if result and sum(stats.nodes.values()) >= generated_min_nodes and position not in positions:
+            positions.append(position)
+    return positions
+
+
+def get_suite(input_path=None, input_format='text', seed=0):
+    # Named positions for the benchmark suite: the tests.py corpus, its cages searched again at generated_depth, the
+    # cages generated with the seed and the positions of an input file in a format read by cages.py.
+    deep_cages_data = [(position, frozen_squares_strings, additional_zone_squares_strings, max(depth, generated_depth))
+                       for (position, frozen_squares_strings, additional_zone_squares_strings, depth)
+                       in test_cages_data]
+    generated_data = [(position, [], [], generated_depth) for position in generate_harder_positions(seed)]
+    suite = []
+    for source, data in [('cages', test_cages_data), ('non-cages', test_non_cages_data), ('deep', deep_cages_data),
+                         ('generated', generated_data)]:
+        for index, entry in enumerate(get_corpus(data), 1):
+            suite.append((f'{source}:{index}', entry))
+    if input_path is not None:
+        parse = input_parsers[input_format]
+        with open(input_path) as input_file:
+            for line_number, line in enumerate(input_file, 1):
+                if line.strip():
+                    suite.append((f'{os.path.basename(input_path)}:{line_number}', parse(line, line_number)))
+    return suite
+
+
+def run_corpus(corpus, engine):
+    known_cages.clear()
+    for position, frozen_squares, additional_squares, depth in corpus:
+        is_cage(get_board_from_forsythe(position), frozen_squares, additional_squares, depth, engine=engine)
+
+
+def get_allocated_size(function):
+    tracemalloc.start()
+    result = function()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del result
+    return size
+
+
+def benchmark_memory(engine):
+    corpus = get_corpus()
+    boards = [ListBoard(get_board_from_forsythe(position)) for position, _, _, _ in corpus]
+    board_snapshot_size = get_allocated_size(lambda: [deepcopy(board) for board in boards]) / len(boards)
+    key_snapshot_size = get_allocated_size(lambda: [get_position_key(board) for board in boards]) / len(boards)
+
+    tracemalloc.start()
+    run_corpus(corpus, engine)
+    traced_peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    print(f'Bytes per cached position as a copied board: {board_snapshot_size:.0f}')
+    print(f'Bytes per cached position as a position key: {key_snapshot_size:.0f}')
+    print(f'Known cages after the corpus: {len(known_cages)}')
+    print(f'Peak traced allocation over the corpus: {traced_peak / 1024:.0f} KiB')
+    print(f'Peak RSS: {peak_rss} KiB')
+
+
+def benchmark_nodes(engine, repeat=20):
+    # The node rate over the whole corpus, with the known cage store cleared before each position so that every
+    # position is searched in full. The nodes are counted in a separate run, since collecting statistics has a
+    # cost of its own, and the fastest of the timed runs is reported.
+    corpus = get_corpus()
+    stats = SearchStats()
+    for position, frozen_squares, additional_squares, depth in corpus:
+        known_cages.clear()
+        is_cage(get_board_from_forsythe(position), frozen_squares, additional_squares, depth, engine=engine,
+                stats=stats)
+    nodes = sum(stats.nodes.values())
+    elapsed_time = None
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        for position, frozen_squares, additional_squares, depth in corpus:
+            known_cages.clear()
+            is_cage(get_board_from_forsythe(position), frozen_squares, additional_squares, depth, engine=engine)
+        run_time = time.perf_counter() - start_time
+        elapsed_time = run_time if elapsed_time is None else min(elapsed_time, run_time)
+    print(f'{engine}: {nodes} nodes in {elapsed_time:.4f}s, {nodes / elapsed_time:.0f} nodes/s')
+
+
+def benchmark_ordering(engine):
+    # Each ordering on the non-cage corpus, each position searched from an empty known cage store.
+    corpus = get_corpus(test_non_cages_data)
+    verdicts = None
+    for name, ordering_class in retraction_orderings.items():
+        ordering = ordering_class()
+        stats = SearchStats()
+        results = []
+        start_time = time.perf_counter()
+        for position, frozen_squares, additional_squares, depth in corpus:
+            known_cages.clear()
+            results.append(is_cage(get_board_from_forsythe(position), frozen_squares, additional_squares, depth,
+                                   engine=engine, stats=stats, ordering=ordering)[0])
+        elapsed_time = time.perf_counter() - start_time
+        if verdicts is None:
+            verdicts = results
+        elif results != verdicts:
+            raise AssertionError(f'Ordering {name} changed the verdicts: {results} instead of {verdicts}')
+        print(f'{name}: {sum(stats.nodes.values())} nodes, {elapsed_time:.4f}s')
+
+
+def measure_position(position, frozen_squares, additional_squares, depth, engine, repeat):
+    # One position of the suite, searched from an empty known cage store each time. The nodes, the peak allocation
+    # and the sizes of the cache and of the known cage store come from a first run with statistics and tracing on,
+    # and the time is the fastest of the runs without them.
+    known_cages.clear()
+    cache = {}
+    stats = SearchStats()
+    tracemalloc.start()
+    result, _ = is_cage(get_board_from_forsythe(position), frozen_squares, additional_squares, depth, engine=engine,
+                        cache=cache, stats=stats)
+    peak_memory = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    known_cages_size = len(known_cages)
+    elapsed_time = None
+    for _ in range(repeat):
+        known_cages.clear()
+        start_time = time.perf_counter()
+        is_cage(get_board_from_forsythe(position), frozen_squares, additional_squares, depth, engine=engine)
+        run_time = time.perf_counter() - start_time
+        elapsed_time = run_time if elapsed_time is None else min(elapsed_time, run_time)
+    known_cages.clear()
+    nodes = sum(stats.nodes.values())
+    return {'position': position, 'depth': depth, 'result': result, 'time': elapsed_time, 'nodes': nodes,
+            'nodes_per_second': nodes / elapsed_time, 'peak_memory': peak_memory, 'cache_size': len(cache),
+            'known_cages': known_cages_size}
+
+
+def benchmark_suite(engine, repeat, input_path=None, input_format='text', seed=0):
+    measurements = {}
+    print(f"{'name':<18} {'result':<7} {'time (ms)':>10} {'nodes':>8} {'nodes/s':>9} {'peak KiB':>9} {'cache':>7} "
+          f"{'cages':>6}")
+    for name, (position, frozen_squares, additional_squares, depth) in get_suite(input_path, input_format, seed):
+        measurement = measure_position(position, frozen_squares, additional_squares, depth, engine, repeat)
+        measurements[name] = measurement
+        print(f"{name:<18} {str(measurement['result']):<7} {measurement['time'] * 1000:>10.2f} "
+              f"{measurement['nodes']:>8} {measurement['nodes_per_second']:>9.0f} "
+              f"{measurement['peak_memory'] / 1024:>9.0f} {measurement['cache_size']:>7} "
+              f"{measurement['known_cages']:>6}")
+    total_time = sum(measurement['time'] for measurement in measurements.values())
+    total_nodes = sum(measurement['nodes'] for measurement in measurements.values())
+    print(f'{len(measurements)} positions: {total_nodes} nodes in {total_time:.4f}s, '
+          f'{total_nodes / total_time:.0f} nodes/s')
+    return {'engine': engine, 'repeat': repeat, 'seed': seed, 'python': platform.python_version(),
+            'positions': measurements}
+
+
+def compare_to_baseline(baseline, current, threshold, min_time):
+    # Returns the regressions of the current suite run against a baseline: a changed verdict, a changed number of
+    # nodes, which means the search itself changed, and a time or peak allocation more than threshold (a fraction)
+    # above the baseline. Times that differ by less than min_time seconds are left out as noise.
+    regressions = []
+    names = [name for name in current['positions'] if name in baseline['positions']]
+    for name in names:
+        measurement, baseline_measurement = current['positions'][name], baseline['positions'][name]
+        if (baseline_measurement['position'], baseline_measurement['depth']) != \
+                (measurement['position'], measurement['depth']):
+            regressions.append(f"{name}: the baseline is for {baseline_measurement['position']} "
+                               f"depth={baseline_measurement['depth']}")
+            continue
+        if measurement['result'] != baseline_measurement['result']:
+            regressions.append(f"{name}: result {measurement['result']} instead of {baseline_measurement['result']}")
+        if measurement['nodes'] != baseline_measurement['nodes']:
+            regressions.append(f"{name}: {measurement['nodes']} nodes instead of {baseline_measurement['nodes']}")
+        if measurement['time'] > baseline_measurement['time'] * (1 + threshold) and \
+                measurement['time'] - baseline_measurement['time'] >= min_time:
+            regressions.append(f"{name}: {measurement['time'] * 1000:.2f}ms instead of "
+                               f"{baseline_measurement['time'] * 1000:.2f}ms")
+        if measurement['peak_memory'] > baseline_measurement['peak_memory'] * (1 + threshold):
+            regressions.append(f"{name}: peak allocation {measurement['peak_memory']} bytes instead of "
+                               f"{baseline_measurement['peak_memory']}")
+    total_time = sum(current['positions'][name]['time'] for name in names)
+    baseline_time = sum(baseline['positions'][name]['time'] for name in names)
+    if total_time > baseline_time * (1 + threshold):
+        regressions.append(f'total: {total_time:.4f}s instead of {baseline_time:.4f}s')
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmarks for the cage verifier on the tests.py corpus')
+    parser.add_argument('benchmark', choices=['memory', 'nodes', 'ordering', 'suite'])
+    parser.add_argument('--engine', choices=list(board_engines), default='list')
+    parser.add_argument('--input', metavar='PATH', help='also run the positions of this input file in the suite')
+    parser.add_argument('--input-format', choices=list(input_parsers), default='text')
+    parser.add_argument('--repeat', type=int, default=5, help='timed runs of each position in the suite')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the generated positions of the suite')
+    parser.add_argument('--save', metavar='PATH', help='save the suite results as a JSON baseline')
+    parser.add_argument('--compare', metavar='PATH', help='compare the suite results to a JSON baseline')
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help='fraction above the baseline at which a time or peak allocation is a regression')
+    parser.add_argument('--min-time', type=float, default=0.002,
+                        help='smallest increase in seconds of the time of a position that is a regression')
+    args = parser.parse_args()
+    if args.benchmark == 'memory':
+        benchmark_memory(args.engine)
+    elif args.benchmark == 'nodes':
+        benchmark_nodes(args.engine)
+    elif args.benchmark == 'ordering':
+        benchmark_ordering(args.engine)
+    elif args.benchmark == 'suite':
+        results = benchmark_suite(args.engine, args.repeat, args.input, args.input_format, args.seed)
+        if args.save:
+            with open(args.save, 'w') as baseline_file:
+                json.dump(results, baseline_file, indent=2)
+        if args.compare:
+            with open(args.compare) as baseline_file:
+                baseline = json.load(baseline_file)
+            if baseline['engine'] != results['engine']:
+                print(f"Warning: the baseline was run with the {baseline['engine']} engine", file=sys.stderr)
+            regressions = compare_to_baseline(baseline, results, args.threshold, args.min_time)
+            for regression in regressions:
+                print(f'Regression: {regression}')
+            if regressions:
+                sys.exit(1)
+            print('No regressions')
@@ -0,0 +1,268 @@
+from concurrent.futures import ProcessPoolExecutor
+import argparse
+import asyncio
+import json
+from cages import *
+
+
+# Reason phrases of the HTTP statuses the server responds with.
+http_reasons = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed',
+                413: 'Payload Too Large'}
+max_request_size = 1 << 24
+# The number of results of verified cages kept in memory by default.
+default_max_results = 100000
+
+
+def get_request_key(position):
+    # Requests for the same position with the squares given in a different order are the same request.
+    forsythe_string, frozen_squares, additional_squares, depth = position
+    return forsythe_string, tuple(sorted(frozen_squares)), tuple(sorted(additional_squares)), depth
+
+
+class CageServer:
+    # A long-running verifier behind a local HTTP server. Positions are verified in a pool of worker processes,
+    # as in a --jobs run, and the server keeps its known cages, including those stored in the database if there is
+    # one, and the results of the cages it has verified in memory between requests, at most max_results of them,
+    # dropping the oldest first. A position that was not verified is searched again on every request, since later
+    # requests may add the cages that prove it. Concurrent requests for the same position share one search. The
+    # positions of a batch request are verified in parallel but committed in order, so a batch gives the results
+    # that a serial run would give starting from the cages known to the server at the time.
+    #
+    # POST /verify takes an input record, {"position": ..., "depth": ..., "frozen": [...], "zone": [...]} as in
+    # --input-format jsonl, or a list of them, and responds with the result record, or a list of them, as in
+    # --jsonl output. GET /stats responds with the counters of the server. max_known_cages limits the known cages of
+    # the server and of its workers as --max-known-cages does. An ordering that learns, such as HistoryOrdering,
+    # would learn from different positions in each worker, so it cannot be used.
+    def __init__(self, jobs=1, database=None, max_known_cages=None, max_results=default_max_results, **options):
+        if options.get('ordering') is not None and options['ordering'].learns:
+            raise ValueError('An ordering that learns cannot be used by the server')
+        self.jobs = jobs
+        self.options = options
+        self.verifier = CageVerifier(KnownCages(max_known_cages), database=database)
+        if database is not None:
+            self.verifier.load_cages()
+        self.results = {}
+        self.max_results = max_results
+        self.pending = {}
+        self.cage_batches = []
+        self.worker_generations = {}
+        self.executor = None
+        self.server = None
+        self.counters = {'requests': 0, 'positions': 0, 'searches': 0, 'cached': 0, 'deduplicated': 0}
+
+    async def start(self, host='127.0.0.1', port=8000):
+        # Returns the asyncio server, which is listening once this returns; with port 0, a free port is chosen.
+        with self.verifier.lock:
+            cages = list(self.verifier.known_cages.items())
+        self.executor = ProcessPoolExecutor(self.jobs, initializer=initialize_batch_worker,
+                                            initargs=(cages, self.verifier.known_cages.max_cages))
+        self.server = await asyncio.start_server(self.handle_connection, host, port)
+        return self.server
+
+    async def stop(self):
+        self.server.close()
+        await self.server.wait_closed()
+        self.executor.shutdown(cancel_futures=True)
+
+    def get_stats(self):
+        return dict(self.counters, known_cages=len(self.verifier.known_cages),
+                    known_cage_evictions=self.verifier.known_cages.evictions, results=len(self.results))
+
+    def submit(self, position):
+        # Starts the search of a position in a worker process, sending it the cage batches it may not have yet.
+        first_generation = min(self.worker_generations.values()) if len(self.worker_generations) == self.jobs else 0
+        self.counters['searches'] += 1
+        return asyncio.get_running_loop().run_in_executor(
+            self.executor, verify_batch_position, position, self.options, first_generation,
+            self.cage_batches[first_generation:], True)
+
+    async def verify(self, position, task=None):
+        # Returns the result record of a position, from the results kept in memory, from a search already running
+        # for the same position or from a new search. task is the search of the position if it was started already.
+        self.counters['positions'] += 1
+        key = get_request_key(position)
+        if key in self.results or key in self.pending:
+            if task is not None:
+                task.cancel()
+            if key in self.results:
+                self.counters['cached'] += 1
+                return self.results[key]
+            self.counters['deduplicated'] += 1
+            return await asyncio.shield(self.pending[key])
+        future = asyncio.get_running_loop().create_future()
+        self.pending[key] = future
+        try:
+            record = await self.search(position, task)
+        except BaseException as e:
+            future.set_exception(e)
+            # The exception is raised here, so it does not have to be retrieved from the future as well.
+            future.exception()
+            raise
+        finally:
+            del self.pending[key]
+        future.set_result(record)
+        if record['result']:
+            self.results[key] = record
+            if len(self.results) > self.max_results:
+                del self.results[next(iter(self.results))]
+        return record
+
+    async def search(self, position, task):
+        database = self.verifier.database
+        if database is not None:
+            database_entry = get_batch_database_entry(position)
+            stored_result = database.get_result(*database_entry)
+            if stored_result is not None:
+                if task is not None:
+                    task.cancel()
+                return get_result_record(position, *stored_result, SearchStats(), 0.0)
+        # A search that ran against an older set of known cages than the server has now is run again, so that the
+        # results are those of a search against every cage committed before it.
+        while True:
+            if task is None:
+                task = self.submit(position)
+            pid, generation, result, retraction_sequence, proven_cages, stats, elapsed_time = await task
+            self.worker_generations[pid] = generation
+            if generation == len(self.cage_batches):
+                break
+            task = None
+        if database is not None and result is not None:
+            database.add_result(*database_entry, result, retraction_sequence)
+        new_cages = self.verifier.save_cages(proven_cages)
+        if new_cages:
+            self.cage_batches.append(proven_cages)
+        return get_result_record(position, result, retraction_sequence, stats, elapsed_time)
+
+    async def verify_record(self, record, index, task=None):
+        # The result record of an input record, or an error record.
+        try:
+            return await self.verify(parse_input_object(record, index), task)
+        except (InvalidInputLineError, ForsytheNotationError, InvalidFrozenSquareError) as e:
+            return {'error': str(e)}
+
+    async def verify_batch(self, records):
+        positions = []
+        for index, record in enumerate(records, 1):
+            try:
+                positions.append(parse_input_object(record, index))
+            except InvalidInputLineError as e:
+                positions.append(e)
+        tasks = [None if isinstance(position, Exception) or get_request_key(position) in self.results
+                 else self.submit(position) for position in positions]
+        results = []
+        for position, task in zip(positions, tasks):
+            if isinstance(position, Exception):
+                results.append({'error': str(position)})
+                continue
+            try:
+                results.append(await self.verify(position, task))
+            except (ForsytheNotationError, InvalidFrozenSquareError) as e:
+                results.append({'error': str(e)})
+        return results
+
+    async def handle_request(self, method, path, body):
+        # Returns the status and the response object.
+        self.counters['requests'] += 1
+        if path == '/stats':
+            if method != 'GET':
+                return 405, {'error': f'{method} is not allowed on {path}'}
+            return 200, self.get_stats()
+        if path != '/verify':
+            return 404, {'error': f'No such path {path}'}
+        if method != 'POST':
+            return 405, {'error': f'{method} is not allowed on {path}'}
+        try:
+            request = json.loads(body)
+        except ValueError:
+            return 400, {'error': 'The request body is not valid JSON'}
+        if isinstance(request, list):
+            return 200, await self.verify_batch(request)
+        response = await self.verify_record(request, 1)
+        return 400 if 'error' in response else 200, response
+
+    async def handle_connection(self, reader, writer):
+        # One request per connection.
+        try:
+            request_line = (await reader.readline()).decode('latin-1').split()
+            headers = {}
+            while True:
+                line = (await reader.readline()).decode('latin-1').strip()
+                if not line:
+                    break
+                name, _, value = line.partition(':')
+                headers[name.strip().lower()] = value.strip()
+            if len(request_line) != 3:
+                status, response = 400, {'error': 'Invalid request line'}
+            else:
+                try:
+                    content_length = int(headers.get('content-length', 0))
+                except ValueError:
+                    content_length = -1
+                if content_length < 0:
+                    status, response = 400, {'error': 'Invalid Content-Length'}
+                elif content_length > max_request_size:
+                    status, response = 413, {'error': f'Request bodies are limited to {max_request_size} bytes'}
+                else:
+                    body = await reader.readexactly(content_length)
+                    status, response = await self.handle_request(request_line[0], request_line[1].split('?')[0],
+                                                                 body)
+            content = json.dumps(response).encode()
+            writer.write(f'HTTP/1.1 {status} {http_reasons[status]}\r\nContent-Type: application/json\r\n'
+                         f'Content-Length: {len(content)}\r\nConnection: close\r\n\r\n'.encode() + content)
+            await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+
+async def serve(host, port, jobs, database, max_known_cages, max_results, options):
+    server = CageServer(jobs, database, max_known_cages, max_results, **options)
+    http_server = await server.start(host, port)
+    print(f"Listening on {', '.join(str(socket.getsockname()) for socket in http_server.sockets)}", flush=True)
+    try:
+        await http_server.serve_forever()
+    finally:
+        await server.stop()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Verify cages posted to a local HTTP server.')
+    parser.add_argument('--host', default='127.0.0.1', help='address to listen on (default: 127.0.0.1)')
+    parser.add_argument('--port', type=int, default=8000, help='port to listen on (default: 8000)')
+    parser.add_argument('--jobs', type=int, default=1,
+                        help='number of worker processes used to verify positions in parallel (default: 1)')
+    parser.add_argument('--iterative-deepening', action='store_true',
+                        help='search to increasing depths and report the shortest escape found')
+    parser.add_argument('--database', metavar='PATH',
+                        help='SQLite file of results and known cages shared between runs; created if it does not exist')
+    parser.add_argument('--ordering', choices=[name for name in retraction_orderings if name != 'history'],
+                        help='order in which retractions are tried; the history ordering learns from the positions '
+                             'searched before, so it cannot be used by the server')
+    parser.add_argument('--minimize-cages', action='store_true',
+                        help='learn each proven cage as a smaller core that is still a cage instead of as every '
+                             'position proven illegal in its search')
+    parser.add_argument('--max-nodes', type=int, metavar='N',
+                        help='give up on a position, reporting it as null, after searching this many positions')
+    parser.add_argument('--timeout', type=float, metavar='SECONDS',
+                        help='give up on a position, reporting it as null, after searching it for this long')
+    parser.add_argument('--max-cache-entries', type=int, metavar='N',
+                        help='keep at most this many positions of the cache of each search in memory')
+    parser.add_argument('--cache-policy', choices=cache_policies, default='depth',
+                        help='positions evicted first from a full cache (default: depth)')
+    parser.add_argument('--max-known-cages', type=int, metavar='N',
+                        help='keep at most this many known cages in memory')
+    parser.add_argument('--max-results', type=int, metavar='N', default=default_max_results,
+                        help=f'keep the results of at most this many verified cages in memory, dropping the oldest '
+                             f'first (default: {default_max_results})')
+    args = parser.parse_args()
+    search_options = {'iterative_deepening': args.iterative_deepening, 'max_nodes': args.max_nodes,
+                      'timeout': args.timeout, 'minimize_cages': args.minimize_cages,
+                      'max_cache_entries': args.max_cache_entries, 'cache_policy': args.cache_policy}
+    if args.ordering:
+        search_options['ordering'] = retraction_orderings[args.ordering]()
+    try:
+        asyncio.run(serve(args.host, args.port, args.jobs, CageDatabase(args.database) if args.database else None,
+                          args.max_known_cages, args.max_results, search_options))
+    except KeyboardInterrupt:
+        pass
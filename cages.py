@@ -1,6 +1,20 @@
-from copy import deepcopy
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from itertools import islice
+from time import monotonic, perf_counter
+import argparse
+import json
+import multiprocessing
+import os
+import sqlite3
 import sys
 import re
+import resource
+import threading
+try:
+    import numpy
+except ImportError:
+    numpy = None
 DEBUG = False
 
 
@@ -12,6 +26,19 @@ class InvalidFrozenSquareError(ValueError):
     pass
 
 
+class InvalidInputLineError(ValueError):
+    pass
+
+
+class InvalidCertificateError(ValueError):
+    pass
+
+
+class SearchLimitReached(Exception):
+    # Raised inside a search that has used up its node or time budget, to unwind it.
+    pass
+
+
 def get_square_string(square):
     return f"{['a', 'b', 'c', 'd', 'e', 'f', 'g', 'h'][square[0]]}{square[1]+1}"
 
@@ -96,6 +123,64 @@ white_pawn_capture_vectors = [(-1, -1), (1, -1)]
 black_pawn_vectors = [(-1, 1), (0, 1), (1, 1)]
 black_pawn_capture_vectors = [(-1, 1), (1, 1)]
 
+
+def get_target_squares(square, vectors):
+    return [(square[0] + vector[0], square[1] + vector[1]) for vector in vectors
+            if 0 <= square[0] + vector[0] < 8 and 0 <= square[1] + vector[1] < 8]
+
+
+def get_ray_squares(square, vector):
+    result = []
+    next_square = (square[0] + vector[0], square[1] + vector[1])
+    while 0 <= next_square[0] < 8 and 0 <= next_square[1] < 8:
+        result.append(next_square)
+        next_square = (next_square[0] + vector[0], next_square[1] + vector[1])
+    return result
+
+
+def get_square_table(function):
+    return [[function((file, rank)) for rank in range(8)] for file in range(8)]
+
+
+def get_square_index(square):
+    return square[1] * 8 + square[0]
+
+
+index_squares = [(index % 8, index // 8) for index in range(64)]
+
+
+# Move tables for the list engine, indexed [file][rank], so that retraction generation and check detection
+# neither build vectors nor check bounds while searching. Targets and rays keep the order of their vectors, and
+# rays stop at the edge of the board.
+king_target_squares = get_square_table(lambda square: get_target_squares(square, queen_vectors))
+knight_target_squares = get_square_table(lambda square: get_target_squares(square, knight_vectors))
+white_pawn_target_squares = get_square_table(lambda square: get_target_squares(square, white_pawn_vectors))
+black_pawn_target_squares = get_square_table(lambda square: get_target_squares(square, black_pawn_vectors))
+queen_ray_squares = get_square_table(lambda square: [get_ray_squares(square, vector) for vector in queen_vectors])
+rook_ray_squares = get_square_table(lambda square: [get_ray_squares(square, vector) for vector in rook_vectors])
+bishop_ray_squares = get_square_table(lambda square: [get_ray_squares(square, vector) for vector in bishop_vectors])
+
+
+def get_checking_units(vector):
+    # The units, frozen or not, that give check to a king from the square at the given vector from it.
+    units = []
+    for unit, check_vectors in [(KING, queen_vectors), (QUEEN, queen_vectors), (ROOK, rook_vectors),
+                                (BISHOP, bishop_vectors), (KNIGHT, knight_vectors)]:
+        if vector in check_vectors:
+            units.extend([(WHITE, unit), (BLACK, unit)])
+    if vector in white_pawn_capture_vectors:
+        units.append((WHITE, PAWN))
+    if vector in black_pawn_capture_vectors:
+        units.append((BLACK, PAWN))
+    return frozenset(units + [color_unit + (True,) for color_unit in units])
+
+
+# For a king on each square, the squares from which a unit could give it an unblockable check, each with the units
+# that would.
+checker_squares = get_square_table(lambda square: [
+    (checker_square, get_checking_units((checker_square[0] - square[0], checker_square[1] - square[1])))
+    for checker_square in get_target_squares(square, queen_vectors + knight_vectors)])
+
 original_squares = {
     (WHITE, ROOK): [get_square('a1'), get_square('h1')],
     (WHITE, KNIGHT): [get_square('b1'), get_square('g1')],
@@ -110,45 +195,146 @@ original_squares = {
     (BLACK, KING): [get_square('e8')],
     (BLACK, PAWN): [(file, 6) for file in range(8)]
 }
-known_cages = []
+# A position key packs a five bit unit code for each square, numbered rank * 8 + file, into a single int, so it
+# identifies the position (frozen flags included) exactly. The key is updated incrementally by adding the value
+# of a unit on a square when it is placed and subtracting it when it is removed. The empty square has code 0.
+#
+# The rules are unchanged if the colors are swapped and the board is flipped vertically, and, for positions without
+# kings or queens, whose home squares are not symmetric, if the board is mirrored left to right. So the search key
+# of a position holds, side by side, the keys of the position and of its images under these transformations, all
+# maintained by the same updates. The low key_size bits are the exact key of the position itself. Above them, the
+# key counts the units that are not on one of their home squares, so that the search can tell when every unit is
+# home without scanning the board.
+key_units = [(EMPTY, EMPTY)] + [(color, unit, *frozen)
+                                for color in [WHITE, BLACK]
+                                for unit in [KING, QUEEN, ROOK, BISHOP, KNIGHT, PAWN]
+                                for frozen in [(), (True,)]]
+key_size = 5 * 64
+key_mask = (1 << key_size) - 1
+
+
+def get_flipped_color_unit(color_unit):
+    if color_unit[1] == EMPTY:
+        return color_unit
+    return (BLACK if color_unit[0] == WHITE else WHITE,) + color_unit[1:]
 
 
-def unoccupied(square, board):
-    return square[0] in range(8) and square[1] in range(8) and board[square[0]][square[1]][1] == EMPTY
+# Each transformation maps (file, rank, color_unit) to its image. The identity comes first, then the color flip,
+# and the two mirrored transformations last.
+key_transformations = [
+    lambda file, rank, color_unit: (file, rank, color_unit),
+    lambda file, rank, color_unit: (file, 7 - rank, get_flipped_color_unit(color_unit)),
+    lambda file, rank, color_unit: (7 - file, rank, color_unit),
+    lambda file, rank, color_unit: (7 - file, 7 - rank, get_flipped_color_unit(color_unit))
+]
+key_codes = {color_unit: code for code, color_unit in enumerate(key_units)}
 
 
-def occupied(square, board):
-    return square[0] in range(8) and square[1] in range(8) and board[square[0]][square[1]][1] != EMPTY
+off_home_shift = key_size * len(key_transformations)
 
 
-def get_vector_retractions(square, vectors, board, unpromote=False, promoted_piece=(EMPTY, EMPTY)):
-    unfiltered = [(square[0] + vector[0], square[1] + vector[1]) for vector in vectors]
-    return [(square, new_square, unpromote, promoted_piece, False) for new_square in unfiltered
-            if unoccupied(new_square, board)]
+def get_square_key(file, rank, color_unit):
+    key = 0
+    for variant, transformation in enumerate(key_transformations):
+        variant_file, variant_rank, variant_color_unit = transformation(file, rank, color_unit)
+        key |= key_codes[variant_color_unit] << (5 * (variant_rank * 8 + variant_file) + key_size * variant)
+    if color_unit[1] != EMPTY and (file, rank) not in original_squares[color_unit[:2]]:
+        key |= 1 << off_home_shift
+    return key
 
 
-def get_line_retractions_along_vector(square, vector, board):
-    result = []
-    next_square = (square[0] + vector[0], square[1] + vector[1])
-    while unoccupied(next_square, board):
-        result.append((square, next_square, False, (EMPTY, EMPTY), False))
-        next_square = (next_square[0] + vector[0], next_square[1] + vector[1])
-    return result
+square_keys = [[{color_unit: get_square_key(file, rank, color_unit) for color_unit in key_units}
+                for rank in range(8)] for file in range(8)]
+
+
+def get_touched_squares(original_square, new_square, uncastle):
+    if not uncastle:
+        return [original_square, new_square]
+    first_rank = original_square[1]
+    if original_square[0] == 6:  # kingside
+        return [original_square, new_square, (5, first_rank), (7, first_rank)]
+    return [original_square, new_square, (3, first_rank), (0, first_rank)]
+
+
+# A retraction is packed into an int: the index of the square the unit is retracted from in the low six bits, the
+# index of the square it is retracted to in the next six, a flag for an unpromotion and one for an uncastling, and
+# above them the key code of the piece that is unpromoted. Every retraction that can be generated is packed once
+# into the retraction tables below, so generating retractions builds no tuples. retraction_fields holds the
+# unpacked (original_square, new_square, unpromote, promoted_piece, uncastle) tuple of each packed retraction, and
+# retraction_touched_squares the squares whose units it changes.
+unpromotion_flag = 1 << 12
+uncastling_flag = 1 << 13
+promoted_piece_shift = 14
+retraction_fields = {}
+retraction_touched_squares = {}
+
+
+def pack_retraction(original_square, new_square, unpromote=False, promoted_piece=(EMPTY, EMPTY), uncastle=False):
+    retraction = get_square_index(original_square) | get_square_index(new_square) << 6 | \
+        (unpromotion_flag if unpromote else 0) | (uncastling_flag if uncastle else 0) | \
+        key_codes[tuple(promoted_piece)] << promoted_piece_shift
+    if retraction not in retraction_fields:
+        retraction_fields[retraction] = (tuple(original_square), tuple(new_square), bool(unpromote),
+                                         tuple(promoted_piece), bool(uncastle))
+        retraction_touched_squares[retraction] = get_touched_squares(original_square, new_square, uncastle)
+    return retraction
+
+
+def unpack_retraction(retraction):
+    return retraction_fields[retraction]
+
+
+def get_retraction_table(target_squares, unpromote=False, promoted_piece=(EMPTY, EMPTY)):
+    # For each square, the (file, rank, retraction) of each target square, in the order of the target squares.
+    return get_square_table(lambda square: [
+        (new_square[0], new_square[1], pack_retraction(square, new_square, unpromote, promoted_piece))
+        for new_square in target_squares[square[0]][square[1]]])
+
+
+def get_ray_retraction_table(ray_squares):
+    return get_square_table(lambda square: [
+        [(new_square[0], new_square[1], pack_retraction(square, new_square)) for new_square in ray]
+        for ray in ray_squares[square[0]][square[1]]])
+
+
+king_retractions = get_retraction_table(king_target_squares)
+knight_retractions = get_retraction_table(knight_target_squares)
+white_pawn_retractions = get_retraction_table(white_pawn_target_squares)
+black_pawn_retractions = get_retraction_table(black_pawn_target_squares)
+queen_ray_retractions = get_ray_retraction_table(queen_ray_squares)
+rook_ray_retractions = get_ray_retraction_table(rook_ray_squares)
+bishop_ray_retractions = get_ray_retraction_table(bishop_ray_squares)
+# Indexed by the promoted piece. Only the tables for the last rank of each color are used.
+white_unpromotion_retractions = {(WHITE, unit): get_retraction_table(white_pawn_target_squares, True, (WHITE, unit))
+                                 for unit in [QUEEN, ROOK, BISHOP, KNIGHT]}
+black_unpromotion_retractions = {(BLACK, unit): get_retraction_table(black_pawn_target_squares, True, (BLACK, unit))
+                                 for unit in [QUEEN, ROOK, BISHOP, KNIGHT]}
+white_kingside_uncastling = pack_retraction((6, 0), (4, 0), uncastle=True)
+white_queenside_uncastling = pack_retraction((2, 0), (4, 0), uncastle=True)
+black_kingside_uncastling = pack_retraction((6, 7), (4, 7), uncastle=True)
+black_queenside_uncastling = pack_retraction((2, 7), (4, 7), uncastle=True)
 
 
-def get_line_retractions(square, vectors, board):
+def get_step_retractions(board, retraction_table):
+    return [retraction for file, rank, retraction in retraction_table if board[file][rank][1] == EMPTY]
+
+
+def get_line_retractions(board, ray_retraction_table):
     result = []
-    for vector in vectors:
-        result.extend(get_line_retractions_along_vector(square, vector, board))
+    for ray in ray_retraction_table:
+        for file, rank, retraction in ray:
+            if board[file][rank][1] != EMPTY:
+                break
+            result.append(retraction)
     return result
 
 
 def get_unpromotions(square, board):
     color_unit = board[square[0]][square[1]]
     if color_unit[0] == WHITE and square[1] == 7:
-        return get_vector_retractions(square, white_pawn_vectors, board, unpromote=True, promoted_piece=color_unit)
+        return get_step_retractions(board, white_unpromotion_retractions[color_unit][square[0]][7])
     elif color_unit[0] == BLACK and square[1] == 0:
-        return get_vector_retractions(square, black_pawn_vectors, board, unpromote=True, promoted_piece=color_unit)
+        return get_step_retractions(board, black_unpromotion_retractions[color_unit][square[0]][0])
     else:
         return []
 
@@ -157,19 +343,19 @@ def get_uncastlings(square, board):
     if square == (6, 0):  # white uncastle kingside
         if board[4][0] == (EMPTY, EMPTY) and board[5][0] == (WHITE, ROOK) and board[6][0] == (WHITE, KING) and \
                 board[7][0] == (EMPTY, EMPTY):
-            return [((6, 0), (4, 0), False, (EMPTY, EMPTY), True)]
+            return [white_kingside_uncastling]
     elif square == (2, 0):  # white uncastle queenside
         if board[0][0] == (EMPTY, EMPTY) and board[1][0] == (EMPTY, EMPTY) and board[2][0] == (WHITE, KING) and \
                 board[3][0] == (WHITE, ROOK) and board[4][0] == (EMPTY, EMPTY):
-            return [((2, 0), (4, 0), False, (EMPTY, EMPTY), True)]
+            return [white_queenside_uncastling]
     elif square == (6, 7):  # black uncastle kingside
         if board[4][7] == (EMPTY, EMPTY) and board[5][7] == (BLACK, ROOK) and board[6][7] == (BLACK, KING) and \
                 board[7][7] == (EMPTY, EMPTY):
-            return [((6, 7), (4, 7), False, (EMPTY, EMPTY), True)]
+            return [black_kingside_uncastling]
     elif square == (2, 7):  # black uncastle queenside
         if board[0][7] == (EMPTY, EMPTY) and board[1][7] == (EMPTY, EMPTY) and board[2][7] == (BLACK, KING) and \
                  board[3][7] == (BLACK, ROOK) and board[4][7] == (EMPTY, EMPTY):
-            return [((2, 7), (4, 7), False, (EMPTY, EMPTY), True)]
+            return [black_queenside_uncastling]
     return []
 
 
@@ -179,24 +365,25 @@ def get_retractions_from_square(board, square):
         return []
     if len(color_unit) > 2 and color_unit[2]:  # frozen
         return []
-    elif color_unit[1] == KING:
-        return get_vector_retractions(square, queen_vectors, board) + get_uncastlings(square, board)
+    file, rank = square
+    if color_unit[1] == KING:
+        return get_step_retractions(board, king_retractions[file][rank]) + get_uncastlings(square, board)
     elif color_unit[1] == QUEEN:
-        return get_line_retractions(square, queen_vectors, board) + get_unpromotions(square, board)
+        return get_line_retractions(board, queen_ray_retractions[file][rank]) + get_unpromotions(square, board)
     elif color_unit[1] == ROOK:
-        return get_line_retractions(square, rook_vectors, board) + get_unpromotions(square, board)
+        return get_line_retractions(board, rook_ray_retractions[file][rank]) + get_unpromotions(square, board)
     elif color_unit[1] == BISHOP:
-        return get_line_retractions(square, bishop_vectors, board) + get_unpromotions(square, board)
+        return get_line_retractions(board, bishop_ray_retractions[file][rank]) + get_unpromotions(square, board)
     elif color_unit[1] == KNIGHT:
-        return get_vector_retractions(square, knight_vectors, board) + get_unpromotions(square, board)
+        return get_step_retractions(board, knight_retractions[file][rank]) + get_unpromotions(square, board)
     elif color_unit[1] == PAWN and color_unit[0] == WHITE:
-        if square[1] >= 2:
-            return get_vector_retractions(square, white_pawn_vectors, board)
+        if rank >= 2:
+            return get_step_retractions(board, white_pawn_retractions[file][rank])
         else:
             return []
     elif color_unit[1] == PAWN and color_unit[0] == BLACK:
-        if square[1] <= 5:
-            return get_vector_retractions(square, black_pawn_vectors, board)
+        if rank <= 5:
+            return get_step_retractions(board, black_pawn_retractions[file][rank])
         else:
             return []
     else:
@@ -204,54 +391,107 @@ def get_retractions_from_square(board, square):
 
 
 def get_retractions(board, squares):
+    # Most squares of a zone are empty, so they are skipped here rather than in get_retractions_from_square.
     result = []
     for square in squares:
-        result.extend(get_retractions_from_square(board, square))
+        if board[square[0]][square[1]][1] != EMPTY:
+            result.extend(get_retractions_from_square(board, square))
     return result
 
 
-def is_unblockable_check_from_square(board, square, king_square):
-    color_unit = board[square[0]][square[1]]
-    if color_unit[1] == EMPTY:
-        return False
-    if color_unit[0] == board[king_square[0]][king_square[1]][0]:
-        return False
-    vector = (square[0] - king_square[0], square[1] - king_square[1])
-    if color_unit[1] == KING:
-        check_vectors = queen_vectors
-    elif color_unit[1] == QUEEN:
-        check_vectors = queen_vectors
-    elif color_unit[1] == ROOK:
-        check_vectors = rook_vectors
-    elif color_unit[1] == BISHOP:
-        check_vectors = bishop_vectors
-    elif color_unit[1] == KNIGHT:
-        check_vectors = knight_vectors
-    elif color_unit[1] == PAWN and color_unit[0] == WHITE:
-        check_vectors = white_pawn_capture_vectors
-    elif color_unit[1] == PAWN and color_unit[0] == BLACK:
-        check_vectors = black_pawn_capture_vectors
-    else:
-        raise ValueError(f"Invalid color_unit {color_unit} at square {square}")
-
-    return vector in check_vectors
-
-
 def get_unblockable_checkers(board, king_square):
     if king_square is None:
         return []
+    king_color = board[king_square[0]][king_square[1]][0]
     result = []
-    for vector in queen_vectors + knight_vectors:
-        new_square = (king_square[0] + vector[0], king_square[1] + vector[1])
-        if occupied(new_square, board) and is_unblockable_check_from_square(board, new_square, king_square):
-            result.append(new_square)
+    for square, checking_units in checker_squares[king_square[0]][king_square[1]]:
+        color_unit = board[square[0]][square[1]]
+        if color_unit in checking_units and color_unit[0] != king_color:
+            result.append(square)
     return result
 
 
-def do_retraction(board, white_king_square, black_king_square, retraction):
-    (original_square, new_square, unpromote, promoted_piece, uncastle) = retraction
+def get_position_key(board):
+    key = 0
+    for file in range(8):
+        for rank in range(8):
+            key += square_keys[file][rank][board[file][rank]]
+    return key
+
+
+def get_key_variants(board):
+    # The number of key variants that apply to the position and every position retracted from it. Retractions
+    # never create a king or a queen.
+    for file in range(8):
+        for rank in range(8):
+            if board[file][rank][1] in [KING, QUEEN]:
+                return 2
+    return 4
+
+
+def get_symmetric_keys(key, key_variants):
+    # The exact keys of the position and of its symmetric images.
+    return [(key >> (key_size * variant)) & key_mask for variant in range(key_variants)]
+
+
+def get_symmetric_units(units):
+    # The images of a cage under the transformations that apply to it, each of which is also a cage.
+    key_variants = 2 if any(color_unit[1] in [KING, QUEEN] for _, _, color_unit in units) else 4
+    return [tuple(sorted(transformation(*unit) for unit in units))
+            for transformation in key_transformations[:key_variants]]
+
+
+def get_units_from_key(key):
+    units = []
+    index = 0
+    key &= key_mask
+    while key:
+        code = key & 31
+        if code:
+            units.append((index % 8, index // 8, key_units[code]))
+        key >>= 5
+        index += 1
+    return tuple(sorted(units))
+
+
+def get_units_key(units):
+    return sum(square_keys[file][rank][color_unit] for file, rank, color_unit in units) & key_mask
+
+
+def get_square_mask(squares):
+    # The squares as a signed 64-bit integer, one bit for each, as SQLite stores integers.
+    mask = sum(1 << (file * 8 + rank) for file, rank in set(squares))
+    return mask - (1 << 64) if mask >= 1 << 63 else mask
+
+
+# The shift of the number of units of each color and kind in a packed count, five bits for each.
+unit_count_shifts = {color_unit: 5 * index for index, color_unit in enumerate(original_squares)}
+
+
+def get_packed_counts(units):
+    return sum(1 << unit_count_shifts[color_unit[:2]] for _, _, color_unit in units)
+
+
+def remove_from_key(board, squares, key):
+    # The key without the units on the squares, before they are moved.
+    for square in squares:
+        key -= square_keys[square[0]][square[1]][board[square[0]][square[1]]]
+    return key
+
+
+def add_to_key(board, squares, key):
+    # The key with the units on the squares, after they are moved.
+    for square in squares:
+        key += square_keys[square[0]][square[1]][board[square[0]][square[1]]]
+    return key
+
+
+def do_retraction(board, white_king_square, black_king_square, retraction, key):
+    (original_square, new_square, unpromote, promoted_piece, uncastle) = retraction_fields[retraction]
     if DEBUG:
         print(f'Retracting {get_square_string(original_square)}-{get_square_string(new_square)}')
+    touched_squares = retraction_touched_squares[retraction]
+    key = remove_from_key(board, touched_squares, key)
     retracted_unit = board[original_square[0]][original_square[1]]
     previous_retractor = retracted_unit[0]
     board[original_square[0]][original_square[1]] = (EMPTY, EMPTY)
@@ -277,13 +517,16 @@ def do_retraction(board, white_king_square, black_king_square, retraction):
         white_king_square = new_square
     elif retracted_unit == (BLACK, KING):
         black_king_square = new_square
-    return board, white_king_square, black_king_square, previous_retractor
+    key = add_to_key(board, touched_squares, key)
+    return board, white_king_square, black_king_square, previous_retractor, key
 
 
-def undo_retraction(board, white_king_square, black_king_square, retraction):
-    (original_square, new_square, unpromote, promoted_piece, uncastle) = retraction
+def undo_retraction(board, white_king_square, black_king_square, retraction, key):
+    (original_square, new_square, unpromote, promoted_piece, uncastle) = retraction_fields[retraction]
     if DEBUG:
         print(f'Undoing {get_square_string(original_square)}-{get_square_string(new_square)}')
+    touched_squares = retraction_touched_squares[retraction]
+    key = remove_from_key(board, touched_squares, key)
 
     if unpromote:
         retracted_unit = promoted_piece
@@ -305,11 +548,12 @@ def undo_retraction(board, white_king_square, black_king_square, retraction):
         else:
             raise ValueError(f"Impossible uncastling {get_square_string(original_square)}-{get_square_string(new_square)}")
 
-    if retracted_unit == (WHITE, KING):
+    if retracted_unit[:2] == (WHITE, KING):
         white_king_square = original_square
-    elif retracted_unit == (BLACK, KING):
+    elif retracted_unit[:2] == (BLACK, KING):
         black_king_square = original_square
-    return board, white_king_square, black_king_square
+    key = add_to_key(board, touched_squares, key)
+    return board, white_king_square, black_king_square, key
 
 
 def in_home_squares(board, squares):
@@ -328,77 +572,821 @@ def contains_cage(board, cage):
     return True
 
 
-def is_cage_internal(board, zone_squares, white_king_square, black_king_square, previous_retractor,
-                     current_path, retraction_sequence, depth, cache):
+def get_board_units(board):
+    return tuple((file, rank, board[file][rank]) for file in range(8) for rank in range(8)
+                 if board[file][rank][1] != EMPTY)
+
+
+def get_board_from_units(units):
+    board = empty_board()
+    for (file, rank, color_unit) in units:
+        board[file][rank] = color_unit
+    return board
+
+
+class KnownCages:
+    # Each cage is filed under one of its units, the anchor, in a per-square index. A board only needs to be
+    # compared against cages whose anchor it contains, and the anchor is chosen from the least populated bucket
+    # so that the buckets stay short as the store grows. With max_cages, the store is kept to that many cages by
+    # evicting those proven at the least remaining depth, the oldest first; cages added without a depth, such as
+    # verified positions, are never evicted. The cages evicted are written to a temporary SQLite database, with the
+    # squares and the numbers of their units, and those that the search of a position may reach (see may_reach_cage)
+    # are put back before it by reserve, so a search gives the same verdict as without the limit. Nothing is evicted
+    # between a reserve and its release, so that the cages put back stay for the whole search.
+    def __init__(self, max_cages=None):
+        self.cages = {}
+        self.buckets = [[{} for _ in range(8)] for _ in range(8)]
+        self.max_cages = max_cages
+        self.evictions = 0
+        self.spill = None
+        self.searches = 0
+
+    def __len__(self):
+        return len(self.cages)
+
+    def __iter__(self):
+        for units, _ in self.items():
+            yield get_board_from_units(units)
+
+    def __contains__(self, units):
+        if units in self.cages:
+            return True
+        return self.spill is not None and self.spill.execute('SELECT 1 FROM spilled WHERE position = ?',
+                                                             (f'{get_units_key(units):x}',)).fetchone() is not None
+
+    def items(self):
+        # The units and depth of every cage, evicted ones included.
+        yield from self.cages.items()
+        if self.spill is not None:
+            for position, depth in self.spill.execute('SELECT position, depth FROM spilled'):
+                yield get_units_from_key(int(position, 16)), depth
+
+    def add(self, units, depth=None):
+        # The symmetric images of the cage are added as well. depth is the remaining depth the cage was proven at,
+        # or None to keep it whatever max_cages is. An image that was evicted is put back with its own depth, or
+        # without one if the cage has none.
+        if units in self.cages:
+            if depth is None:
+                for symmetric_units in get_symmetric_units(units):
+                    if symmetric_units in self.cages:
+                        self.cages[symmetric_units] = None
+            return
+        for symmetric_units in get_symmetric_units(units):
+            if not symmetric_units or symmetric_units in self.cages:
+                continue
+            symmetric_depth = depth
+            if self.spill is not None:
+                position = f'{get_units_key(symmetric_units):x}'
+                row = self.spill.execute('SELECT depth FROM spilled WHERE position = ?', (position,)).fetchone()
+                if row is not None:
+                    self.spill.execute('DELETE FROM spilled WHERE position = ?', (position,))
+                    if depth is not None:
+                        symmetric_depth = row[0]
+            self.cages[symmetric_units] = symmetric_depth
+            self.file_cage(symmetric_units)
+        if self.max_cages is not None and len(self.cages) > self.max_cages:
+            self.evict()
+
+    def file_cage(self, units):
+        anchor = min(units, key=lambda unit: len(self.buckets[unit[0]][unit[1]].get(unit[2], ())))
+        remaining_units = tuple(unit for unit in units if unit != anchor)
+        self.buckets[anchor[0]][anchor[1]].setdefault(anchor[2], []).append((remaining_units, units))
+
+    def evict(self):
+        # Evicts down to three quarters of max_cages at once, so that the index is rebuilt only once in a while.
+        if self.searches:
+            return
+        evictable_units = sorted((units for units, depth in self.cages.items() if depth is not None),
+                                 key=self.cages.get)
+        evicted_units = evictable_units[:len(self.cages) - self.max_cages * 3 // 4]
+        if self.spill is None:
+            self.spill = sqlite3.connect('', isolation_level=None, check_same_thread=False)
+            self.spill.execute('CREATE TABLE spilled (position TEXT PRIMARY KEY, squares INTEGER NOT NULL, '
+                               'counts INTEGER NOT NULL, depth INTEGER NOT NULL) WITHOUT ROWID')
+        self.spill.executemany('INSERT INTO spilled (position, squares, counts, depth) VALUES (?, ?, ?, ?)',
+                               [(f'{get_units_key(units):x}', get_square_mask((file, rank) for file, rank, _ in units),
+                                 get_packed_counts(units), self.cages.pop(units)) for units in evicted_units])
+        self.evictions += len(evicted_units)
+        for buckets_file in self.buckets:
+            for bucket in buckets_file:
+                bucket.clear()
+        for units in self.cages:
+            self.file_cage(units)
+
+    def reserve(self, units, zone_squares):
+        # Puts back the evicted cages that the search of a position with these units and zone may reach, and keeps
+        # every cage until release is called.
+        self.searches += 1
+        if self.spill is None:
+            return
+        # The query checks what may_reach_cage does: the squares of the cage against those outside the zone, and
+        # the number of units of each color and kind against those the position may have.
+        outside_squares = get_square_mask((file, rank) for file in range(8) for rank in range(8)
+                                          if (file, rank) not in zone_squares and (file, rank) not in uncastling_squares)
+        counts = get_unit_counts(units)
+        available_counts = [counts.get((color, unit), 0) +
+                            (sum(counts.get((color, piece), 0) for piece in [QUEEN, ROOK, BISHOP, KNIGHT])
+                             if unit == PAWN else 0) for color, unit in original_squares]
+        conditions = ''.join(f' AND counts >> {shift} & 31 <= ?' for shift in unit_count_shifts.values())
+        restored_positions = []
+        for position, depth in self.spill.execute(f'SELECT position, depth FROM spilled WHERE squares & ? = 0'
+                                                  f'{conditions}', [outside_squares] + available_counts).fetchall():
+            cage_units = get_units_from_key(int(position, 16))
+            self.cages[cage_units] = depth
+            self.file_cage(cage_units)
+            restored_positions.append((position,))
+        self.spill.executemany('DELETE FROM spilled WHERE position = ?', restored_positions)
+
+    def release(self):
+        # Evicts the cages over max_cages once no search is running.
+        self.searches -= 1
+        if not self.searches and self.max_cages is not None and len(self.cages) > self.max_cages:
+            self.evict()
+
+    def find(self, board):
+        if not self.cages:
+            return None
+        for file in range(8):
+            board_file = board[file]
+            buckets_file = self.buckets[file]
+            for rank in range(8):
+                color_unit = board_file[rank]
+                if color_unit[1] == EMPTY:
+                    continue
+                bucket = buckets_file[rank].get(color_unit)
+                if bucket is None:
+                    continue
+                for (remaining_units, units) in bucket:
+                    for (cage_file, cage_rank, cage_color_unit) in remaining_units:
+                        if board[cage_file][cage_rank] != cage_color_unit:
+                            break
+                    else:
+                        return units
+        return None
+
+    def clear(self):
+        self.cages.clear()
+        self.evictions = 0
+        self.spill = None
+        for buckets_file in self.buckets:
+            for bucket in buckets_file:
+                bucket.clear()
+
+
+known_cages = KnownCages()
+
+
+def set_unit(board, square, color_unit):
+    board[square[0]][square[1]] = color_unit
+
+
+class ListBoard(list):
+    # The board as a list of files, each a list of (color, unit[, frozen]) tuples, searched with the functions above.
+    get_retractions = get_retractions
+    get_unblockable_checkers = get_unblockable_checkers
+    do_retraction = do_retraction
+    undo_retraction = undo_retraction
+    in_home_squares = in_home_squares
+    set_unit = set_unit
+
+
+# Bitboards use one bit per square, numbered rank * 8 + file, as returned by get_square_index.
+def get_target_indices(index, vectors):
+    file, rank = index % 8, index // 8
+    return [get_square_index((file + vector[0], rank + vector[1])) for vector in vectors
+            if 0 <= file + vector[0] < 8 and 0 <= rank + vector[1] < 8]
+
+
+def get_ray_indices(index, vector):
+    result = []
+    file, rank = index % 8 + vector[0], index // 8 + vector[1]
+    while 0 <= file < 8 and 0 <= rank < 8:
+        result.append(get_square_index((file, rank)))
+        file, rank = file + vector[0], rank + vector[1]
+    return result
+
+
+def get_mask(indices):
+    mask = 0
+    for index in indices:
+        mask |= 1 << index
+    return mask
+
+
+king_targets = [get_target_indices(index, queen_vectors) for index in range(64)]
+knight_targets = [get_target_indices(index, knight_vectors) for index in range(64)]
+white_pawn_targets = [get_target_indices(index, white_pawn_vectors) for index in range(64)]
+black_pawn_targets = [get_target_indices(index, black_pawn_vectors) for index in range(64)]
+king_masks = [get_mask(targets) for targets in king_targets]
+knight_masks = [get_mask(targets) for targets in knight_targets]
+rook_step_masks = [get_mask(get_target_indices(index, rook_vectors)) for index in range(64)]
+bishop_step_masks = [get_mask(get_target_indices(index, bishop_vectors)) for index in range(64)]
+# A pawn of the given color on one of these squares gives check to a king on the indexed square.
+pawn_checker_masks = {
+    WHITE: [get_mask(get_target_indices(index, white_pawn_capture_vectors)) for index in range(64)],
+    BLACK: [get_mask(get_target_indices(index, black_pawn_capture_vectors)) for index in range(64)]
+}
+# Rays are indexed by the position of their direction in queen_vectors and run outward from the square.
+rays = [[get_ray_indices(index, vector) for vector in queen_vectors] for index in range(64)]
+ray_masks = [[get_mask(ray) for ray in square_rays] for square_rays in rays]
+ray_is_ascending = [vector[1] * 8 + vector[0] > 0 for vector in queen_vectors]
+rook_directions = [queen_vectors.index(vector) for vector in rook_vectors]
+bishop_directions = [queen_vectors.index(vector) for vector in bishop_vectors]
+queen_directions = rook_directions + bishop_directions
+square_distances = [[max(abs(index % 8 - other % 8), abs(index // 8 - other // 8)) for other in range(64)]
+                    for index in range(64)]
+home_masks = {color_unit: get_mask(get_square_index(square) for square in squares)
+              for color_unit, squares in original_squares.items()}
+# The packed retractions of the targets and rays above, in the same order, taken from the list engine's tables.
+king_target_retractions = [[retraction for _, _, retraction in king_retractions[file][rank]]
+                           for rank in range(8) for file in range(8)]
+knight_target_retractions = [[retraction for _, _, retraction in knight_retractions[file][rank]]
+                             for rank in range(8) for file in range(8)]
+white_pawn_target_retractions = [[retraction for _, _, retraction in white_pawn_retractions[file][rank]]
+                                 for rank in range(8) for file in range(8)]
+black_pawn_target_retractions = [[retraction for _, _, retraction in black_pawn_retractions[file][rank]]
+                                 for rank in range(8) for file in range(8)]
+white_unpromotion_target_retractions = {
+    color_unit: [[retraction for _, _, retraction in table[file][rank]] for rank in range(8) for file in range(8)]
+    for color_unit, table in white_unpromotion_retractions.items()}
+black_unpromotion_target_retractions = {
+    color_unit: [[retraction for _, _, retraction in table[file][rank]] for rank in range(8) for file in range(8)]
+    for color_unit, table in black_unpromotion_retractions.items()}
+ray_retractions = [[[retraction for _, _, retraction in ray] for ray in queen_ray_retractions[file][rank]]
+                   for rank in range(8) for file in range(8)]
+
+
+class BitBoard:
+    # The board as one bitboard per color and unit, plus occupancy and frozen masks. A mailbox copy of the
+    # units is kept alongside so that board[file][rank] reads work as they do on a ListBoard.
+    def __init__(self, board):
+        self.files = [[(EMPTY, EMPTY) for _ in range(8)] for _ in range(8)]
+        self.pieces = {color: {unit: 0 for unit in [KING, QUEEN, ROOK, BISHOP, KNIGHT, PAWN]}
+                       for color in [WHITE, BLACK]}
+        self.occupied = 0
+        self.frozen = 0
+        self.zone = None
+        self.zone_mask = 0
+        for file in range(8):
+            for rank in range(8):
+                if board[file][rank][1] != EMPTY:
+                    self.set_unit((file, rank), board[file][rank])
+
+    def __getitem__(self, file):
+        return self.files[file]
+
+    def set_unit(self, square, color_unit):
+        bit = 1 << get_square_index(square)
+        old_color_unit = self.files[square[0]][square[1]]
+        if old_color_unit[1] != EMPTY:
+            self.pieces[old_color_unit[0]][old_color_unit[1]] &= ~bit
+            self.occupied &= ~bit
+            self.frozen &= ~bit
+        self.files[square[0]][square[1]] = color_unit
+        if color_unit[1] != EMPTY:
+            self.pieces[color_unit[0]][color_unit[1]] |= bit
+            self.occupied |= bit
+            if len(color_unit) > 2 and color_unit[2]:
+                self.frozen |= bit
+
+    def get_step_retractions(self, targets, target_retractions):
+        occupied = self.occupied
+        return [retraction for target, retraction in zip(targets, target_retractions) if not occupied >> target & 1]
+
+    def get_line_retractions(self, index, directions):
+        result = []
+        for direction in directions:
+            retractions = ray_retractions[index][direction]
+            blockers = ray_masks[index][direction] & self.occupied
+            if blockers:
+                if ray_is_ascending[direction]:
+                    nearest_blocker = (blockers & -blockers).bit_length() - 1
+                else:
+                    nearest_blocker = blockers.bit_length() - 1
+                retractions = retractions[:square_distances[index][nearest_blocker] - 1]
+            result.extend(retractions)
+        return result
+
+    def get_unpromotions(self, square, index, color_unit):
+        if color_unit[0] == WHITE and square[1] == 7:
+            return self.get_step_retractions(white_pawn_targets[index],
+                                             white_unpromotion_target_retractions[color_unit][index])
+        elif color_unit[0] == BLACK and square[1] == 0:
+            return self.get_step_retractions(black_pawn_targets[index],
+                                             black_unpromotion_target_retractions[color_unit][index])
+        else:
+            return []
+
+    def get_retractions_from_square(self, square):
+        color_unit = self.files[square[0]][square[1]]
+        index = get_square_index(square)
+        if color_unit[1] == EMPTY or self.frozen >> index & 1:
+            return []
+        elif color_unit[1] == KING:
+            return self.get_step_retractions(king_targets[index], king_target_retractions[index]) + \
+                get_uncastlings(square, self)
+        elif color_unit[1] == QUEEN:
+            return self.get_line_retractions(index, queen_directions) + self.get_unpromotions(square, index, color_unit)
+        elif color_unit[1] == ROOK:
+            return self.get_line_retractions(index, rook_directions) + self.get_unpromotions(square, index, color_unit)
+        elif color_unit[1] == BISHOP:
+            return self.get_line_retractions(index, bishop_directions) + \
+                self.get_unpromotions(square, index, color_unit)
+        elif color_unit[1] == KNIGHT:
+            return self.get_step_retractions(knight_targets[index], knight_target_retractions[index]) + \
+                self.get_unpromotions(square, index, color_unit)
+        elif color_unit[1] == PAWN and color_unit[0] == WHITE:
+            return self.get_step_retractions(white_pawn_targets[index], white_pawn_target_retractions[index]) \
+                if square[1] >= 2 else []
+        elif color_unit[1] == PAWN and color_unit[0] == BLACK:
+            return self.get_step_retractions(black_pawn_targets[index], black_pawn_target_retractions[index]) \
+                if square[1] <= 5 else []
+        else:
+            raise ValueError(f"Invalid color_unit {color_unit} at square {square}")
+
+    def get_retractions(self, squares):
+        occupied = self.occupied
+        result = []
+        for square in squares:
+            if occupied >> (square[1] * 8 + square[0]) & 1:
+                result.extend(self.get_retractions_from_square(square))
+        return result
+
+    def get_unblockable_checkers(self, king_square):
+        if king_square is None:
+            return []
+        index = get_square_index(king_square)
+        opponent = BLACK if self.files[king_square[0]][king_square[1]][0] == WHITE else WHITE
+        pieces = self.pieces[opponent]
+        checkers = (king_masks[index] & (pieces[KING] | pieces[QUEEN])) | \
+            (rook_step_masks[index] & pieces[ROOK]) | \
+            (bishop_step_masks[index] & pieces[BISHOP]) | \
+            (knight_masks[index] & pieces[KNIGHT]) | \
+            (pawn_checker_masks[opponent][index] & pieces[PAWN])
+        result = []
+        while checkers:
+            lowest_bit = checkers & -checkers
+            result.append(index_squares[lowest_bit.bit_length() - 1])
+            checkers ^= lowest_bit
+        return result
+
+    def do_retraction(self, white_king_square, black_king_square, retraction, key):
+        (original_square, new_square, unpromote, promoted_piece, uncastle) = retraction_fields[retraction]
+        if DEBUG:
+            print(f'Retracting {get_square_string(original_square)}-{get_square_string(new_square)}')
+        touched_squares = retraction_touched_squares[retraction]
+        key = remove_from_key(self, touched_squares, key)
+        retracted_unit = self.files[original_square[0]][original_square[1]]
+        previous_retractor = retracted_unit[0]
+        self.set_unit(original_square, (EMPTY, EMPTY))
+        if unpromote:
+            self.set_unit(new_square, (promoted_piece[0], PAWN))
+        else:
+            self.set_unit(new_square, retracted_unit)
+
+        if uncastle:  # move the rook
+            first_rank = original_square[1]
+            if original_square[0] == 6:  # kingside
+                rook_square, new_rook_square = (5, first_rank), (7, first_rank)
+            elif original_square[0] == 2:  # queenside
+                rook_square, new_rook_square = (3, first_rank), (0, first_rank)
+            else:
+                raise ValueError(f"Impossible uncastling {get_square_string(original_square)}-" +
+                                 f"{get_square_string(new_square)}")
+            rook = self.files[rook_square[0]][rook_square[1]]
+            self.set_unit(new_square, (retracted_unit[0], retracted_unit[1], True))  # freeze king
+            self.set_unit(new_rook_square, (rook[0], rook[1], True))  # freeze rook
+            self.set_unit(rook_square, (EMPTY, EMPTY))
+
+        if retracted_unit == (WHITE, KING):
+            white_king_square = new_square
+        elif retracted_unit == (BLACK, KING):
+            black_king_square = new_square
+        key = add_to_key(self, touched_squares, key)
+        return self, white_king_square, black_king_square, previous_retractor, key
+
+    def undo_retraction(self, white_king_square, black_king_square, retraction, key):
+        (original_square, new_square, unpromote, promoted_piece, uncastle) = retraction_fields[retraction]
+        if DEBUG:
+            print(f'Undoing {get_square_string(original_square)}-{get_square_string(new_square)}')
+        touched_squares = retraction_touched_squares[retraction]
+        key = remove_from_key(self, touched_squares, key)
+
+        if unpromote:
+            retracted_unit = promoted_piece
+        else:
+            retracted_unit = self.files[new_square[0]][new_square[1]]
+        self.set_unit(new_square, (EMPTY, EMPTY))
+        self.set_unit(original_square, retracted_unit)
+
+        if uncastle:  # move the rook
+            first_rank = original_square[1]
+            if original_square[0] == 6:  # kingside
+                rook_square, new_rook_square = (5, first_rank), (7, first_rank)
+            elif original_square[0] == 2:  # queenside
+                rook_square, new_rook_square = (3, first_rank), (0, first_rank)
+            else:
+                raise ValueError(f"Impossible uncastling {get_square_string(original_square)}-" +
+                                 f"{get_square_string(new_square)}")
+            rook = self.files[new_rook_square[0]][new_rook_square[1]]
+            self.set_unit(original_square, retracted_unit[:2])  # unfreeze king
+            self.set_unit(rook_square, rook[:2])  # unfreeze rook
+            self.set_unit(new_rook_square, (EMPTY, EMPTY))
+
+        if retracted_unit[:2] == (WHITE, KING):
+            white_king_square = original_square
+        elif retracted_unit[:2] == (BLACK, KING):
+            black_king_square = original_square
+        key = add_to_key(self, touched_squares, key)
+        return self, white_king_square, black_king_square, key
+
+    def in_home_squares(self, squares):
+        if squares is not self.zone:
+            self.zone = squares
+            self.zone_mask = get_mask(get_square_index(square) for square in squares)
+        for color_unit, home_mask in home_masks.items():
+            if self.pieces[color_unit[0]][color_unit[1]] & self.zone_mask & ~home_mask:
+                return False
+        return True
+
+
+board_engines = {'list': ListBoard, 'bitboard': BitBoard}
+
+
+class SearchStats:
+    # Counters filled in by a search when is_cage is given a SearchStats, for finding out where the time goes. Nodes
+    # are counted by remaining depth, and times are in seconds. known_cage_matches counts the hits on each known cage by
+    # its units. Collecting them costs a little time of its own, but nothing when they are not collected.
+    def __init__(self):
+        self.nodes = {}
+        self.cache_hits = 0
+        self.loop_cutoffs = 0
+        self.illegal_check_cutoffs = 0
+        self.known_cage_hits = 0
+        self.known_cage_matches = {}
+        self.removed_unit_shortcuts = 0
+        self.retraction_time = 0.0
+        self.check_time = 0.0
+        self.cage_matching_time = 0.0
+        self.cache_entries = 0
+        self.cache_evictions = 0
+
+    def merge(self, other):
+        for depth, nodes in other.nodes.items():
+            self.nodes[depth] = self.nodes.get(depth, 0) + nodes
+        self.cache_hits += other.cache_hits
+        self.loop_cutoffs += other.loop_cutoffs
+        self.illegal_check_cutoffs += other.illegal_check_cutoffs
+        self.known_cage_hits += other.known_cage_hits
+        for units, hits in other.known_cage_matches.items():
+            self.known_cage_matches[units] = self.known_cage_matches.get(units, 0) + hits
+        self.removed_unit_shortcuts += other.removed_unit_shortcuts
+        self.retraction_time += other.retraction_time
+        self.check_time += other.check_time
+        self.cage_matching_time += other.cage_matching_time
+        self.cache_entries = max(self.cache_entries, other.cache_entries)
+        self.cache_evictions += other.cache_evictions
+
+    def format(self):
+        nodes_by_depth = ', '.join(f'{depth}: {self.nodes[depth]}' for depth in sorted(self.nodes, reverse=True))
+        return '\n'.join([
+            f'  nodes: {sum(self.nodes.values())} (by remaining depth {nodes_by_depth})' if self.nodes
+            else '  nodes: 0',
+            f'  cutoffs: cache {self.cache_hits}, loop {self.loop_cutoffs}, '
+            f'illegal check {self.illegal_check_cutoffs}, known cage {self.known_cage_hits}, '
+            f'removed units {self.removed_unit_shortcuts}',
+            f'  time: retraction generation {self.retraction_time:.6f}s, check detection {self.check_time:.6f}s, '
+            f'cage matching {self.cage_matching_time:.6f}s',
+            f'  cache: {self.cache_entries} entries, {self.cache_evictions} evicted'])
+
+
+class BoundedCache(dict):
+    # A search cache that holds at most max_entries positions in memory. With the depth policy, the positions proven
+    # at the least remaining depth are evicted first, the oldest first among those; with the lru policy, those looked
+    # up least recently. The positions evicted are written to a temporary SQLite database, where a lookup that misses
+    # in memory finds them and moves them back, so the cache answers every lookup as an unbounded one would and a
+    # search gives the same verdict with it, and items holds them along with the others, so that they are learned as
+    # known cages. Two bits set in a bitmap for each position evicted spare the query for most positions that never
+    # were.
+    def __init__(self, max_entries, policy='depth'):
+        super().__init__()
+        self.max_entries = max_entries
+        self.policy = policy
+        self.evictions = 0
+        self.spill = None
+        self.spill_filter = bytearray(2 * max_entries + 1)
+
+    def __reduce__(self):
+        # Sent between processes as the plain dict of its entries, evicted ones included.
+        return dict, (dict(self.items()),)
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def __getitem__(self, key):
+        depth = self.get(key)
+        if depth is None:
+            raise KeyError(key)
+        return depth
+
+    def __setitem__(self, key, depth):
+        dict.pop(self, key, None)
+        dict.__setitem__(self, key, depth)
+        if len(self) > self.max_entries:
+            self.evict()
+
+    def get(self, key, default=None):
+        depth = dict.get(self, key)
+        if depth is not None:
+            if self.policy == 'lru':
+                dict.__setitem__(self, key, dict.pop(self, key))
+            return depth
+        if not all(self.spill_filter[bit >> 3] & (1 << (bit & 7)) for bit in self.get_filter_bits(key)):
+            return default
+        row = self.spill.execute('SELECT depth FROM spilled WHERE position = ?', (f'{key:x}',)).fetchone()
+        if row is None:
+            return default
+        self[key] = row[0]
+        return row[0]
+
+    def update(self, entries):
+        for key, depth in entries.items():
+            self[key] = depth
+
+    def items(self):
+        yield from dict.items(self)
+        if self.spill is not None:
+            for position, depth in self.spill.execute('SELECT position, depth FROM spilled'):
+                key = int(position, 16)
+                if not dict.__contains__(self, key):
+                    yield key, depth
+
+    def values(self):
+        return (depth for _, depth in self.items())
+
+    def clear(self):
+        dict.clear(self)
+        self.spill = None
+        self.spill_filter = bytearray(len(self.spill_filter))
+
+    def get_filter_bits(self, key):
+        filter_hash = hash(key)
+        size = len(self.spill_filter) * 8
+        return filter_hash % size, filter_hash // size % size
+
+    def evict(self):
+        # Evicts down to three quarters of max_entries at once, so that the depth policy sorts only once in a while.
+        # A position moved back from the database stays there as well, and is written over if evicted again.
+        excess = len(self) - self.max_entries * 3 // 4
+        if self.policy == 'lru':
+            evicted_keys = list(islice(dict.__iter__(self), excess))
+        else:
+            evicted_keys = sorted(dict.__iter__(self), key=lambda key: dict.get(self, key))[:excess]
+        if self.spill is None:
+            self.spill = sqlite3.connect('', isolation_level=None, check_same_thread=False)
+            self.spill.execute('CREATE TABLE spilled (position TEXT PRIMARY KEY, depth INTEGER NOT NULL) '
+                               'WITHOUT ROWID')
+        self.spill.executemany('INSERT OR REPLACE INTO spilled (position, depth) VALUES (?, ?)',
+                               [(f'{key:x}', dict.pop(self, key)) for key in evicted_keys])
+        for key in evicted_keys:
+            for bit in self.get_filter_bits(key):
+                self.spill_filter[bit >> 3] |= 1 << (bit & 7)
+        self.evictions += len(evicted_keys)
+
+
+cache_policies = ['depth', 'lru']
+
+
+# The Chebyshev distance from each square to the nearest home square of each unit.
+home_distances = {color_unit: [[min(max(abs(file - home_file), abs(rank - home_rank))
+                                    for home_file, home_rank in squares) for rank in range(8)] for file in range(8)]
+                  for color_unit, squares in original_squares.items()}
+
+
+class RetractionOrdering:
+    # Decides the order in which the retractions from a position are tried in the search for an escape home that
+    # comes before the search giving the verdict (see find_escape), so the verdict does not depend on the order, but
+    # trying the likely escapes first lets that search find one sooner; the retraction sequence reported may be a
+    # different one. This base ordering keeps the order in which the retractions were generated. Orderings can learn
+    # from record_escape, which is called for each retraction after which the position was not proven illegal, with
+    # the remaining depth it was tried at. An ordering that learns sets learns, since its order for a position then
+    # depends on the positions searched before it, which only a serial run searches in input order.
+    learns = False
+
+    def order(self, board, retractions, depth):
+        return retractions
+
+    def record_escape(self, retraction, depth):
+        pass
+
+
+class HomeSquaresOrdering(RetractionOrdering):
+    # Uncastlings and unpromotions first, then the retractions that bring a unit nearest to one of its home
+    # squares, since a position with every unit home is an escape.
+    def get_priority(self, board, retraction):
+        original_square, new_square, unpromote, promoted_piece, uncastle = retraction_fields[retraction]
+        if uncastle or unpromote:
+            return -1
+        color_unit = board[original_square[0]][original_square[1]]
+        return home_distances[color_unit[:2]][new_square[0]][new_square[1]]
+
+    def order(self, board, retractions, depth):
+        return sorted(retractions, key=lambda retraction: self.get_priority(board, retraction))
+
+
+class HistoryOrdering(RetractionOrdering):
+    # Tries first the retraction that last escaped at the same remaining depth (the killer), then the retractions
+    # by how often, weighted by remaining depth, they escaped before, in the order of the base ordering otherwise.
+    # The history is kept between searches, so an instance can be reused for a series of positions.
+    learns = True
+
+    def __init__(self, base_ordering=None):
+        self.base_ordering = base_ordering or RetractionOrdering()
+        self.history = {}
+        self.killers = {}
+
+    def order(self, board, retractions, depth):
+        retractions = self.base_ordering.order(board, retractions, depth)
+        if not self.history:
+            return retractions
+        killer = self.killers.get(depth)
+        return sorted(retractions, key=lambda retraction: (retraction != killer, -self.history.get(retraction, 0)))
+
+    def record_escape(self, retraction, depth):
+        self.history[retraction] = self.history.get(retraction, 0) + depth * depth
+        self.killers[depth] = retraction
+        self.base_ordering.record_escape(retraction, depth)
+
+
+retraction_orderings = {
+    'generated': RetractionOrdering,
+    'home': HomeSquaresOrdering,
+    'history': lambda: HistoryOrdering(HomeSquaresOrdering())
+}
+
+
+class Search:
+    # The state shared by every node of one search: the zone, the proven-illegal positions with the remaining depth
+    # each was proven at, the positions on the current path and the retractions leading to the current node.
+    # depth_limit_verdict is the result of a node where the maximum depth is reached: False, or None while
+    # searching for an escape home, since that is not one. A cached position normally counts as illegal whatever depth
+    # it was proven at; with check_cache_depth, only if it was proven with at least the remaining depth. The cache
+    # is keyed by exact keys, and holds the symmetric images of each position proven illegal along with it, so that
+    # a lookup stays a single dict access. stats is a SearchStats to count into, or None, and ordering is the
+    # RetractionOrdering to try retractions in, or None to try them as generated. The search raises
+    # SearchLimitReached once it visits more than max_nodes positions or runs past the deadline, a time.monotonic()
+    # time; the cache then still holds only positions that were proven illegal. cages is the KnownCages to match
+    # positions against, the module's known cages by default. With record_proof, proof holds a token for each
+    # position visited, in the order they are visited (see check_certificate), and proof_cages the index of each
+    # known cage cited in it. A position proven illegal through a loop cutoff is only proven for the path it was
+    # reached by; with track_loop_proofs, loop_proofs holds the keys of the cached positions whose proofs depend on a
+    # loop cutoff, or on a cache hit on such a position, so that they can be dropped before the cache is reused.
+    def __init__(self, zone_squares, cache, key_variants, depth_limit_verdict=False, check_cache_depth=False,
+                 stats=None, ordering=None, max_nodes=None, deadline=None, cages=None, record_proof=False,
+                 track_loop_proofs=False):
+        self.zone_squares = zone_squares
+        self.cache = cache
+        self.key_variants = key_variants
+        self.current_path = set()
+        self.retraction_sequence = []
+        self.depth_limit_verdict = depth_limit_verdict
+        self.check_cache_depth = check_cache_depth
+        self.stats = stats
+        self.ordering = ordering
+        self.max_nodes = max_nodes
+        self.deadline = deadline
+        self.limited = max_nodes is not None or deadline is not None
+        self.nodes = 0
+        self.known_cages = known_cages if cages is None else cages
+        self.proof = [] if record_proof else None
+        self.proof_cages = {}
+        self.loop_proofs = set() if track_loop_proofs else None
+        self.loop_cutoff = False
+
+    def check_limits(self):
+        self.nodes += 1
+        if self.max_nodes is not None and self.nodes > self.max_nodes:
+            raise SearchLimitReached(f'Node limit of {self.max_nodes} reached')
+        if self.deadline is not None and monotonic() > self.deadline:
+            raise SearchLimitReached('Time limit reached')
+
+
+def get_node_verdict(board, white_king_square, black_king_square, previous_retractor, depth, key, search):
+    # Returns the verdict for the position and None, or None and the squares whose units may be retracted if the
+    # search must continue. The verdict is True if the position is illegal, False if the search fails here and None
+    # if it cannot be decided at this depth.
     if DEBUG:
         print(f'Depth remaining: {depth}')
         print_board(board)
+    if search.limited:
+        search.check_limits()
+    stats = search.stats
+    if stats is not None:
+        stats.nodes[depth] = stats.nodes.get(depth, 0) + 1
 
     # check cache
-    if board in cache:
+    exact_key = key & key_mask
+    if exact_key in search.cache and (not search.check_cache_depth or search.cache[exact_key] >= depth):
         if DEBUG:
             print('Illegal because already in cache')
-        return True
+        if stats is not None:
+            stats.cache_hits += 1
+        if search.proof is not None:
+            search.proof.append('C')
+        if search.loop_proofs is not None and exact_key in search.loop_proofs:
+            search.loop_cutoff = True
+        return True, None
 
     # check for loop to an existing position on the current path
-    if board in current_path:
+    if key in search.current_path:
         if DEBUG:
             print('Illegal because of a loop')
-        return True
+        if stats is not None:
+            stats.loop_cutoffs += 1
+        if search.proof is not None:
+            search.proof.append('L')
+        search.loop_cutoff = True
+        return True, None
 
     # no double (or higher) checks and both kings cannot be in check
-    white_king_checkers = get_unblockable_checkers(board, white_king_square)
-    black_king_checkers = get_unblockable_checkers(board, black_king_square)
+    if stats is not None:
+        start_time = perf_counter()
+    white_king_checkers = board.get_unblockable_checkers(white_king_square)
+    black_king_checkers = board.get_unblockable_checkers(black_king_square)
+    if stats is not None:
+        stats.check_time += perf_counter() - start_time
     if len(white_king_checkers) + len(black_king_checkers) > 1:
         if DEBUG:
             print('Illegal because of an illegal check')
-        return True
+        if stats is not None:
+            stats.illegal_check_cutoffs += 1
+        if search.proof is not None:
+            search.proof.append('X')
+        return True, None
 
     # previous retractor cannot leave the opposing king in check
     if previous_retractor == WHITE and len(black_king_checkers) > 0:
         if DEBUG:
             print('Illegal because previous retraction left opposing king in check')
-        return True
+        if stats is not None:
+            stats.illegal_check_cutoffs += 1
+        if search.proof is not None:
+            search.proof.append('X')
+        return True, None
     if previous_retractor == BLACK and len(white_king_checkers) > 0:
         if DEBUG:
             print('Illegal because previous retraction left opposing king in check')
-        return True
+        if stats is not None:
+            stats.illegal_check_cutoffs += 1
+        if search.proof is not None:
+            search.proof.append('X')
+        return True, None
 
     # check if position contains an already known illegal cage
-    for cage in known_cages:
-        if contains_cage(board, cage):
-            if DEBUG:
-                print('Illegal because it contains a previously known cage: ')
-                print_board(cage)
-            return True
+    if stats is not None:
+        start_time = perf_counter()
+    cage = search.known_cages.find(board)
+    if stats is not None:
+        stats.cage_matching_time += perf_counter() - start_time
+    if cage is not None:
+        if stats is not None:
+            stats.known_cage_hits += 1
+            stats.known_cage_matches[cage] = stats.known_cage_matches.get(cage, 0) + 1
+        if DEBUG:
+            print('Illegal because it contains a previously known cage: ')
+            print_board(get_board_from_units(cage))
+        if search.proof is not None:
+            search.proof.append(f'K{search.proof_cages.setdefault(cage, len(search.proof_cages))}')
+        return True, None
 
     # check if maximum depth reached
     if depth == 0:
         if DEBUG:
             print('Failure because maximum depth reached')
             print_board(board)
-        return False
+        return search.depth_limit_verdict, None
 
     # check if all units are back in their home squares
-    if in_home_squares(board, zone_squares):
+    if key >> off_home_shift == 0:
         if DEBUG:
             print('Failure because all units are back on their home squares')
             print_board(board)
-        return False
+        return False, None
 
     # If someone is in check, then only the checking unit can be retracted.
     # Otherwise, any unit can be retracted.
     if len(white_king_checkers) + len(black_king_checkers) > 0:
-        possible_squares = [(white_king_checkers + black_king_checkers)[0]]
+        return None, [(white_king_checkers + black_king_checkers)[0]]
     else:
-        possible_squares = zone_squares
+        return None, search.zone_squares
 
-    retractions = get_retractions(board, possible_squares)
-    removed_units = []
 
+def remove_escaping_units(board, zone_squares, white_king_square, black_king_square, retractions,
+                          retraction_sequence, key):
     # Remove any units that can be retracted outside of the zone
+    removed_units = []
     for retraction in retractions:
-        (original_square, new_square, unpromote, promoted_piece, uncastle) = retraction
+        (original_square, new_square, unpromote, promoted_piece, uncastle) = retraction_fields[retraction]
         if not uncastle and new_square not in zone_squares:
             removed_unit = board[original_square[0]][original_square[1]]
             if removed_unit[1] == EMPTY:  # we already removed this unit from another retraction
@@ -409,47 +1397,489 @@ def is_cage_internal(board, zone_squares, white_king_square, black_king_square,
                 print(f'Removing {removed_unit} from {get_square_string(original_square)} because it can retract to ' +
                       f'{get_square_string(new_square)}')
                 print_board(board)
-            board[original_square[0]][original_square[1]] = (EMPTY, EMPTY)
+            board.set_unit(original_square, (EMPTY, EMPTY))
+            key -= square_keys[original_square[0]][original_square[1]][removed_unit]
             if removed_unit == (WHITE, KING):
                 white_king_square = None
             elif removed_unit == (BLACK, KING):
                 black_king_square = None
-
-    if removed_units:
-        # If we removed any units, then recurse with the position after removing those units.
-        if not is_cage_internal(board, zone_squares, white_king_square, black_king_square,
-                                previous_retractor, current_path, retraction_sequence, depth-1, cache):
-            return False
-        for removed_unit in removed_units:
-            del retraction_sequence[-1]
-            board[removed_unit[0]][removed_unit[1]] = removed_unit[2]
-            if DEBUG:
-                print(f'Restoring {removed_unit[2]} at {get_square_string((removed_unit[0], removed_unit[1]))}')
-            if removed_unit[2] == (WHITE, KING):
-                white_king_square = (removed_unit[0], removed_unit[1])
-            elif removed_unit[2] == (BLACK, KING):
-                black_king_square = (removed_unit[0], removed_unit[1])
-    else:
-        # Otherwise, recurse with each possible retraction.
-        current_path.append(deepcopy(board))
-        for retraction in retractions:
-            retraction_sequence.append(retraction)
-            (board, white_king_square, black_king_square, previous_retractor) = \
-                do_retraction(board, white_king_square, black_king_square, retraction)
-            if not is_cage_internal(board, zone_squares, white_king_square, black_king_square,
-                                    previous_retractor, current_path, retraction_sequence, depth-1, cache):
-                return False
-            del retraction_sequence[-1]
-            (board, white_king_square, black_king_square) = \
-                undo_retraction(board, white_king_square, black_king_square, retraction)
-        del current_path[-1]
-    if DEBUG:
-        print('Illegal because all retractions from this position were illegal')
-    cache.append(deepcopy(board))
-    return True
-
-
-def is_cage(board, frozen_squares, additional_zone_squares, depth, save=True):
+    return removed_units, white_king_square, black_king_square, key
+
+
+def is_cage_internal(board, white_king_square, black_king_square, previous_retractor, depth, key, search):
+    # A depth first search with an explicit stack, which holds a frame for each position on the current path whose
+    # successors are being searched: [iterator over the remaining retractions, retraction being searched, key, white
+    # king square, black king square, remaining depth, undecided, removed units, depends on a loop cutoff]. A frame
+    # with removed units has a single successor, the position without them, and no retractions. The verdict of each
+    # position is returned to the frame below it, with whether it depends on a loop cutoff, until some frame has
+    # another retraction to try.
+    retraction_sequence = search.retraction_sequence
+    current_path = search.current_path
+    ordering = search.ordering
+    stats = search.stats
+    stack = []
+    while True:
+        verdict, possible_squares = get_node_verdict(board, white_king_square, black_king_square, previous_retractor,
+                                                     depth, key, search)
+        returning = possible_squares is None
+        loop_dependent = search.loop_cutoff
+        search.loop_cutoff = False
+        if not returning:
+            if stats is not None:
+                start_time = perf_counter()
+            retractions = board.get_retractions(possible_squares)
+            if stats is not None:
+                stats.retraction_time += perf_counter() - start_time
+            frame = [None, None, key, white_king_square, black_king_square, depth, False, None, False]
+            removed_units, white_king_square, black_king_square, key = \
+                remove_escaping_units(board, search.zone_squares, white_king_square, black_king_square, retractions,
+                                      retraction_sequence, key)
+            if search.proof is not None:
+                search.proof.append('R' if removed_units else 'A')
+            if removed_units:
+                # If we removed any units, then continue with the position after removing those units.
+                if stats is not None:
+                    stats.removed_unit_shortcuts += 1
+                frame[0] = iter(())
+                frame[7] = removed_units
+                stack.append(frame)
+                depth -= 1
+                continue
+            # Otherwise, continue with each possible retraction.
+            if ordering is not None:
+                retractions = ordering.order(board, retractions, depth)
+            frame[0] = iter(retractions)
+            current_path.add(key)
+            stack.append(frame)
+
+        while True:
+            if returning:
+                if not stack:
+                    return verdict
+                frame = stack[-1]
+                if loop_dependent:
+                    frame[8] = True
+                removed_units = frame[7]
+                if removed_units is None:
+                    if ordering is not None and verdict is not True:
+                        ordering.record_escape(frame[1], frame[5])
+                    if verdict is False:
+                        return False
+                    del retraction_sequence[-1]
+                    (board, white_king_square, black_king_square, key) = \
+                        board.undo_retraction(white_king_square, black_king_square, frame[1], key)
+                else:
+                    if verdict is False:
+                        return False
+                    for removed_unit in removed_units:
+                        del retraction_sequence[-1]
+                        board.set_unit((removed_unit[0], removed_unit[1]), removed_unit[2])
+                        if DEBUG:
+                            print(f'Restoring {removed_unit[2]} at ' +
+                                  f'{get_square_string((removed_unit[0], removed_unit[1]))}')
+                    key, white_king_square, black_king_square = frame[2], frame[3], frame[4]
+                if verdict is None:
+                    frame[6] = True
+            retraction = next(frame[0], None)
+            if retraction is not None:
+                frame[1] = retraction
+                retraction_sequence.append(retraction)
+                (board, white_king_square, black_king_square, previous_retractor, key) = \
+                    board.do_retraction(white_king_square, black_king_square, retraction, key)
+                depth = frame[5] - 1
+                break
+            if frame[7] is None:
+                current_path.remove(key)
+            stack.pop()
+            returning = True
+            loop_dependent = frame[8]
+            if frame[6]:
+                if DEBUG:
+                    print('Undecided because some retractions reached the maximum depth')
+                verdict = None
+            else:
+                if DEBUG:
+                    print('Illegal because all retractions from this position were illegal')
+                for symmetric_key in get_symmetric_keys(key, search.key_variants):
+                    search.cache[symmetric_key] = frame[5]
+                    if loop_dependent and search.loop_proofs is not None:
+                        search.loop_proofs.add(symmetric_key)
+                verdict = True
+
+
+# Root splitting expands the search tree breadth first until there are enough open nodes to keep the workers busy,
+# but never more than this many plies from the root.
+max_split_plies = 4
+split_nodes_per_worker = 8
+# The position being split in a root splitting worker process:
+# (board, engine, zone_squares, white_king_square, black_king_square, depth, key, key_variants, collect_stats,
+#  deadline)
+split_root = None
+
+
+def replay_split_steps(board, white_king_square, black_king_square, key, steps, search):
+    # Each step is either (False, retraction) for a retraction or (True, retractions) for the removal of the
+    # units that can leave the zone with those retractions.
+    previous_retractor = None
+    for removal, retractions in steps:
+        if removal:
+            _, white_king_square, black_king_square, key = \
+                remove_escaping_units(board, search.zone_squares, white_king_square, black_king_square, retractions,
+                                      search.retraction_sequence, key)
+        else:
+            search.current_path.add(key)
+            search.retraction_sequence.append(retractions)
+            (board, white_king_square, black_king_square, previous_retractor, key) = \
+                board.do_retraction(white_king_square, black_king_square, retractions, key)
+    return white_king_square, black_king_square, previous_retractor, key
+
+
+def get_split_frontier(board, engine, zone_squares, white_king_square, black_king_square, depth, key, key_variants,
+                       size, stats, cages):
+    # Returns the open nodes as lists of steps, a dict of the expanded nodes with their remaining depth, which are
+    # illegal if every open node is, and the retraction sequence of a failure found while expanding, if any.
+    frontier = [[]]
+    expanded_nodes = {}
+    for _ in range(max_split_plies):
+        if len(frontier) >= size:
+            break
+        next_frontier = []
+        for steps in frontier:
+            node_board = board_engines[engine]([list(file) for file in board])
+            search = Search(zone_squares, {}, key_variants, stats=stats, cages=cages)
+            node_white_king_square, node_black_king_square, previous_retractor, node_key = \
+                replay_split_steps(node_board, white_king_square, black_king_square, key, steps, search)
+            verdict, possible_squares = get_node_verdict(node_board, node_white_king_square, node_black_king_square,
+                                                         previous_retractor, depth - len(steps), node_key, search)
+            if verdict is False:
+                return [], {}, search.retraction_sequence
+            elif possible_squares is None:
+                continue
+            for symmetric_key in get_symmetric_keys(node_key, key_variants):
+                expanded_nodes[symmetric_key] = depth - len(steps)
+            retractions = node_board.get_retractions(possible_squares)
+            removed_units, _, _, _ = remove_escaping_units(node_board, zone_squares, node_white_king_square,
+                                                           node_black_king_square, retractions,
+                                                           search.retraction_sequence, node_key)
+            if removed_units:
+                next_frontier.append(steps + [(True, tuple(search.retraction_sequence[-len(removed_units):]))])
+            else:
+                next_frontier.extend(steps + [(False, retraction)] for retraction in retractions)
+        frontier = next_frontier
+    return frontier, expanded_nodes, None
+
+
+def initialize_split_worker(cages, root):
+    global split_root
+    known_cages.clear()
+    for units in cages:
+        known_cages.add(units)
+    split_root = root
+
+
+def verify_split_node(steps):
+    board, engine, zone_squares, white_king_square, black_king_square, depth, key, key_variants, collect_stats, \
+        deadline = split_root
+    board = board_engines[engine]([list(file) for file in board])
+    search = Search(zone_squares, {}, key_variants, stats=SearchStats() if collect_stats else None, deadline=deadline)
+    white_king_square, black_king_square, previous_retractor, key = \
+        replay_split_steps(board, white_king_square, black_king_square, key, steps, search)
+    try:
+        result = is_cage_internal(board, white_king_square, black_king_square, previous_retractor, depth - len(steps),
+                                  key, search)
+    except SearchLimitReached:
+        return None, [], None, search.stats
+    return result, search.retraction_sequence, search.cache if result else None, search.stats
+
+
+def is_cage_split(board, engine, zone_squares, white_king_square, black_king_square, depth, key, key_variants, workers,
+                  cache, stats, deadline, cages, cage_units):
+    # A position is a cage only if every open node below it is illegal, so the open nodes are verified independently
+    # in a pool of worker processes, and the pool is stopped as soon as one of them fails. The workers are given
+    # cage_units, the units of each of the known cages in cages. A worker starts with an empty cache, so it can reach
+    # the maximum depth at a position that the serial search finds in its cache; a failure that does not lead all the
+    # way home is therefore only a failure if the serial search fails as well, and the position is searched again
+    # with it. The caches of the workers are only added to the cache once every open node is proven illegal.
+    frontier, expanded_nodes, retraction_sequence = \
+        get_split_frontier(board, engine, zone_squares, white_king_square, black_king_square, depth, key,
+                           key_variants, workers * split_nodes_per_worker, stats, cages)
+    node_caches = []
+    if retraction_sequence is None:
+        root = ([list(file) for file in board], engine, zone_squares, white_king_square, black_king_square, depth,
+                key, key_variants, stats is not None, deadline)
+        with multiprocessing.Pool(workers, initializer=initialize_split_worker,
+                                  initargs=(cage_units, root)) as pool:
+            for result, retraction_sequence, node_cache, node_stats in pool.imap_unordered(verify_split_node,
+                                                                                           frontier):
+                if stats is not None:
+                    stats.merge(node_stats)
+                if result is None:
+                    raise SearchLimitReached('Time limit reached')
+                if not result:
+                    break
+                node_caches.append(node_cache)
+            else:
+                retraction_sequence = None
+    if retraction_sequence is not None:
+        if escapes_home(get_board_units(board), zone_squares, retraction_sequence):
+            return False, retraction_sequence
+        search = Search(zone_squares, cache, key_variants, stats=stats, deadline=deadline, cages=cages)
+        result = is_cage_internal(board_engines[engine]([list(file) for file in board]), white_king_square,
+                                  black_king_square, None, depth, key, search)
+        return result, search.retraction_sequence
+    for node_cache in node_caches:
+        cache.update(node_cache)
+    cache.update(expanded_nodes)
+    return True, []
+
+
+# The searches for an escape before the search that gives the verdict visit at most this many positions in all.
+escape_search_nodes = 1000
+
+
+def find_escape(board, engine, zone_squares, white_king_square, black_king_square, depths, key, key_variants, stats,
+                ordering, max_nodes, deadline, cages):
+    # Searches the position to each of the depths in turn for a retraction sequence that leads all the way home,
+    # trying the retractions in ordering, and returns the first one found, or None, with the number of positions
+    # visited. Reaching the maximum depth is not a failure in these searches, so they only fail on such a sequence,
+    # which every search of the position fails on too, and a sequence found at the smallest depth is a shortest one.
+    # They keep the proven-illegal positions from one to the next in a cache of their own, and stop once one of them
+    # proves the position illegal or they have visited escape_search_nodes positions between them, so that a search
+    # that gives the verdict can follow them at little cost. The positions whose proofs depend on a loop cutoff hold
+    # only for the path they were reached by in their search, so they are dropped from the cache before the next.
+    nodes = 0
+    escape_cache = {}
+    for escape_depth in depths:
+        escape_nodes = escape_search_nodes - nodes
+        if max_nodes is not None:
+            escape_nodes = min(escape_nodes, max_nodes - nodes)
+        search = Search(zone_squares, escape_cache, key_variants, None, check_cache_depth=True, stats=stats,
+                        ordering=ordering, max_nodes=escape_nodes, deadline=deadline, cages=cages,
+                        track_loop_proofs=True)
+        try:
+            result = is_cage_internal(board_engines[engine]([list(file) for file in board]), white_king_square,
+                                      black_king_square, None, escape_depth, key, search)
+        except SearchLimitReached:
+            nodes += search.nodes
+            if max_nodes is not None and nodes > max_nodes:
+                raise SearchLimitReached(f'Node limit of {max_nodes} reached')
+            if deadline is not None and monotonic() > deadline:
+                raise
+            break
+        nodes += search.nodes
+        if result is False:
+            return search.retraction_sequence, nodes
+        if result:
+            break
+        for loop_proof_key in search.loop_proofs:
+            escape_cache.pop(loop_proof_key, None)
+    return None, nodes
+
+
+def get_certificate_units(key_string):
+    # The units of a position key written in hex in a certificate.
+    if not isinstance(key_string, str) or not re.fullmatch('[0-9a-f]+', key_string):
+        raise InvalidCertificateError(f'Not a position key: {key_string!r}')
+    key = int(key_string, 16)
+    if key > key_mask or any((key >> (5 * index)) & 31 >= len(key_units) for index in range(64)):
+        raise InvalidCertificateError(f'Not a position key: {key_string}')
+    return get_units_from_key(key)
+
+
+def check_certificate(certificate, cages=None, engine='list'):
+    # A certificate proves a cage without a search. It holds the position, as the hex key of its units, frozen units
+    # included, the zone, the depth, the known cages it cites and the proof, a token for each position of the search
+    # tree in depth first order: C if the position was proven illegal earlier in the proof, L for a loop to a
+    # position on the current path, X for an illegal check, K and an index into the cited cages for a position
+    # containing that cage, R if units that can leave the zone are removed, followed by the proof of the position
+    # without them, and A if every retraction is illegal, followed by the proofs of the positions after each of them
+    # in the order get_retractions generates them. Every position is visited once and only the claim of its token is
+    # checked, so checking takes time linear in the size of the proof. The cited cages must be in cages, the
+    # module's known cages by default. Returns the positions proven illegal, as the cache of the search, which
+    # save_cages adds to the known cages, or raises InvalidCertificateError.
+    cages = known_cages if cages is None else cages
+    try:
+        units = get_certificate_units(certificate['position'])
+        if not isinstance(certificate['zone'], list) or \
+                not all(isinstance(square_string, str) and re.fullmatch('[a-h][1-8]', square_string)
+                        for square_string in certificate['zone']):
+            raise InvalidCertificateError(f"The zone is not a list of squares: {certificate['zone']}")
+        zone_squares = {get_square(square_string) for square_string in certificate['zone']}
+        depth = certificate['depth']
+        if not isinstance(depth, int) or isinstance(depth, bool) or depth < 0:
+            raise InvalidCertificateError(f'The depth is not a nonnegative integer: {depth!r}')
+        if not isinstance(certificate['cages'], list):
+            raise InvalidCertificateError(f"The cages are not a list: {certificate['cages']}")
+        cited_cages = [get_certificate_units(cage) for cage in certificate['cages']]
+        if not isinstance(certificate['proof'], str) or not re.fullmatch(r'(K\d+|[CLXRA])*', certificate['proof']):
+            raise InvalidCertificateError('The proof is not a string of tokens')
+        tokens = re.findall(r'K\d+|.', certificate['proof'])
+    except (KeyError, IndexError, TypeError) as e:
+        raise InvalidCertificateError(f'Malformed certificate: {e!r}')
+    for cage_units in cited_cages:
+        if cage_units not in cages:
+            raise InvalidCertificateError(f'The certificate cites a cage that is not known: {cage_units}')
+    board = board_engines[engine](get_board_from_units(units))
+    white_king_square = next(((file, rank) for file, rank, color_unit in units if color_unit[:2] == (WHITE, KING)),
+                             None)
+    black_king_square = next(((file, rank) for file, rank, color_unit in units if color_unit[:2] == (BLACK, KING)),
+                             None)
+    key = get_position_key(board)
+    key_variants = get_key_variants(board)
+    proven = {}
+    current_path = set()
+    previous_retractor = None
+    # A frame for each position on the current path whose successors are being checked: [iterator over the remaining
+    # retractions, retraction being checked, key, white king square, black king square, remaining depth, removed
+    # units], as in is_cage_internal.
+    stack = []
+    for index, token in enumerate(tokens):
+        if token in ['A', 'R']:
+            white_king_checkers = board.get_unblockable_checkers(white_king_square)
+            black_king_checkers = board.get_unblockable_checkers(black_king_square)
+            if depth == 0 or key >> off_home_shift == 0:
+                raise InvalidCertificateError(f'Token {index} continues from a position where the search fails')
+            checkers = white_king_checkers + black_king_checkers
+            retractions = board.get_retractions(checkers[:1] if checkers else zone_squares)
+            frame = [None, None, key, white_king_square, black_king_square, depth, None]
+            removed_units, white_king_square, black_king_square, key = \
+                remove_escaping_units(board, zone_squares, white_king_square, black_king_square, retractions, [], key)
+            if (token == 'R') != bool(removed_units):
+                raise InvalidCertificateError(f'Token {index} is {token}, but units can '
+                                              f'{"not " if token == "R" else ""}be removed')
+            if removed_units:
+                frame[0] = iter(())
+                frame[6] = removed_units
+                stack.append(frame)
+                depth -= 1
+                continue
+            frame[0] = iter(retractions)
+            current_path.add(key)
+            stack.append(frame)
+            returning = False
+        else:
+            if token == 'C':
+                valid = key & key_mask in proven
+            elif token == 'L':
+                valid = key in current_path
+            elif token == 'X':
+                white_king_checkers = board.get_unblockable_checkers(white_king_square)
+                black_king_checkers = board.get_unblockable_checkers(black_king_square)
+                valid = len(white_king_checkers) + len(black_king_checkers) > 1 or \
+                    previous_retractor == WHITE and len(black_king_checkers) > 0 or \
+                    previous_retractor == BLACK and len(white_king_checkers) > 0
+            elif token[0] == 'K':
+                cage_index = int(token[1:])
+                valid = cage_index < len(cited_cages) and \
+                    all(board[file][rank] == color_unit for file, rank, color_unit in cited_cages[cage_index])
+            else:
+                raise InvalidCertificateError(f'Token {index} is not valid: {token}')
+            if not valid:
+                raise InvalidCertificateError(f'Token {index} claims {token}, which does not hold')
+            returning = True
+
+        # Go back up to the first position with another retraction to check.
+        while True:
+            if returning:
+                if not stack:
+                    break
+                frame = stack[-1]
+                if frame[6] is None:
+                    (board, white_king_square, black_king_square, key) = \
+                        board.undo_retraction(white_king_square, black_king_square, frame[1], key)
+                else:
+                    for file, rank, color_unit in frame[6]:
+                        board.set_unit((file, rank), color_unit)
+                    key, white_king_square, black_king_square = frame[2], frame[3], frame[4]
+            frame = stack[-1]
+            retraction = next(frame[0], None)
+            if retraction is not None:
+                frame[1] = retraction
+                (board, white_king_square, black_king_square, previous_retractor, key) = \
+                    board.do_retraction(white_king_square, black_king_square, retraction, key)
+                depth = frame[5] - 1
+                break
+            if frame[6] is None:
+                current_path.remove(key)
+            stack.pop()
+            for symmetric_key in get_symmetric_keys(key, key_variants):
+                proven[symmetric_key] = frame[5]
+            returning = True
+        if not stack:
+            if index != len(tokens) - 1:
+                raise InvalidCertificateError(f'The proof is complete at token {index}, but it goes on')
+            return proven
+    raise InvalidCertificateError('The proof ends before every position is proven illegal')
+
+
+class CageDatabase:
+    # Verified results, and proven-illegal positions to be used as known cages, kept in an SQLite database so that
+    # they can be shared between runs. Results are keyed by the position key of the board with its frozen units,
+    # the zone and the depth. Only cages are kept as results: a position that was not verified may be verified once
+    # more cages are known, so it is always searched again. Databases written before kept failures as well, and
+    # those rows are ignored. The database uses write-ahead logging and every write is a short transaction, so
+    # several processes can read and write the same file at once.
+    def __init__(self, path):
+        self.connection = sqlite3.connect(path, timeout=60, isolation_level=None, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.last_cage_id = 0
+        with self.transaction():
+            self.connection.execute('CREATE TABLE IF NOT EXISTS cages (id INTEGER PRIMARY KEY AUTOINCREMENT, '
+                                    'position TEXT UNIQUE NOT NULL, depth INTEGER NOT NULL)')
+            self.connection.execute('CREATE TABLE IF NOT EXISTS results (position TEXT NOT NULL, zone TEXT NOT NULL, '
+                                    'depth INTEGER NOT NULL, result INTEGER NOT NULL, '
+                                    'retraction_sequence TEXT NOT NULL, PRIMARY KEY (position, zone, depth))')
+
+    @contextmanager
+    def transaction(self):
+        self.connection.execute('BEGIN IMMEDIATE')
+        try:
+            yield
+        except BaseException:
+            self.connection.execute('ROLLBACK')
+            raise
+        self.connection.execute('COMMIT')
+
+    def load_cages(self, cages):
+        # Adds the cages stored since the last call, including those stored by other processes.
+        for cage_id, position, depth in self.connection.execute('SELECT id, position, depth FROM cages WHERE id > ? '
+                                                                'ORDER BY id', (self.last_cage_id,)).fetchall():
+            cages.add(get_units_from_key(int(position, 16)), depth)
+            self.last_cage_id = cage_id
+
+    def add_cages(self, cache):
+        with self.transaction():
+            self.connection.executemany('INSERT OR IGNORE INTO cages (position, depth) VALUES (?, ?)',
+                                        [(f'{key:x}', depth) for key, depth in cache.items()])
+
+    def get_result(self, key, zone_squares, depth):
+        row = self.connection.execute('SELECT result, retraction_sequence FROM results '
+                                      'WHERE position = ? AND zone = ? AND depth = ? AND result = 1',
+                                      (f'{key & key_mask:x}', get_zone_string(zone_squares), depth)).fetchone()
+        if row is None:
+            return None
+        # Retraction sequences are stored unpacked, so that the format does not depend on the packing.
+        return bool(row[0]), [pack_retraction(*retraction) for retraction in json.loads(row[1])]
+
+    def add_result(self, key, zone_squares, depth, result, retraction_sequence):
+        if not result:
+            return
+        with self.transaction():
+            self.connection.execute('INSERT OR REPLACE INTO results (position, zone, depth, result, '
+                                    'retraction_sequence) VALUES (?, ?, ?, ?, ?)',
+                                    (f'{key & key_mask:x}', get_zone_string(zone_squares), depth, result,
+                                     json.dumps([unpack_retraction(retraction) for retraction in retraction_sequence])))
+
+    def close(self):
+        self.connection.close()
+
+
+def get_zone_string(zone_squares):
+    return ','.join(sorted(get_square_string(square) for square in zone_squares))
+
+
+def prepare_board(board, frozen_squares, additional_zone_squares):
+    # Marks the frozen units on the board and returns the zone and the squares of the kings.
     white_king_square = None
     black_king_square = None
     zone_squares = set(additional_zone_squares)
@@ -475,28 +1905,280 @@ def is_cage(board, frozen_squares, additional_zone_squares, depth, save=True):
                                            f"This is not its home square.")
         else:
             board[frozen_square[0]][frozen_square[1]] = (color_unit[0], color_unit[1], True)
+    return zone_squares, white_king_square, black_king_square
+
+
+class CageVerifier:
+    # A verification session with its own known cages, which start as the given KnownCages or empty and grow with
+    # every cage it proves, and the search options it applies to every position. With collect_stats, stats holds the
+    # totals of all its searches. A verifier never prints, and one verifier can be used from several threads at once:
+    # each search has its own cache and statistics, and the shared state (the known cages, the database and the
+    # totals) is only changed under a lock. The ordering is shared by all the searches, so an ordering that learns,
+    # such as history, learns from all of them. With minimize_cages, a proven cage is learned as its minimized core
+    # (see minimize_cage) instead of as every position proven illegal in its search. With max_cache_entries, the
+    # cache of each search is a BoundedCache with that many entries in memory and cache_policy. The known cages are
+    # reserved for each search (see KnownCages), so neither limit changes a verdict.
+    def __init__(self, known_cages=None, engine='list', workers=1, iterative_deepening=False, database=None,
+                 ordering=None, max_nodes=None, timeout=None, collect_stats=False, minimize_cages=False,
+                 max_cache_entries=None, cache_policy='depth'):
+        if engine not in board_engines:
+            raise ValueError(f"Unknown engine {engine} (valid engines are: {', '.join(board_engines)})")
+        if cache_policy not in cache_policies:
+            raise ValueError(f"Unknown cache policy {cache_policy} (valid policies are: {', '.join(cache_policies)})")
+        if iterative_deepening and workers > 1:
+            raise ValueError("Iterative deepening cannot be combined with more than one worker")
+        if max_nodes is not None and workers > 1:
+            raise ValueError("A node limit cannot be combined with more than one worker")
+        self.known_cages = KnownCages() if known_cages is None else known_cages
+        self.engine = engine
+        self.workers = workers
+        self.iterative_deepening = iterative_deepening
+        self.database = database
+        self.ordering = ordering
+        self.max_nodes = max_nodes
+        self.timeout = timeout
+        self.stats = SearchStats() if collect_stats else None
+        self.minimize_cages = minimize_cages
+        self.max_cache_entries = max_cache_entries
+        self.cache_policy = cache_policy
+        self.lock = threading.Lock()
+
+    def new_cache(self):
+        if self.max_cache_entries is None:
+            return {}
+        return BoundedCache(self.max_cache_entries, self.cache_policy)
+
+    def load_cages(self):
+        # Adds the cages stored in the database since the last call.
+        with self.lock:
+            self.database.load_cages(self.known_cages)
+
+    def is_cage(self, board, frozen_squares, additional_zone_squares, depth, save=True, cache=None, stats=None,
+                certificate=None):
+        # Returns the result and a retraction sequence leading out of the cage if it is not one. The result is None
+        # if the search was cut off after visiting max_nodes positions or running for timeout seconds; stats then
+        # holds the counts so far, and cache the positions proven illegal so far, which can be passed to a later
+        # attempt on the same position. With minimize_cages, the cache of a cage is replaced by its minimized core.
+        # With certificate, a dict, the position is searched with a plain depth first search, whatever the options,
+        # and never looked up in the database, and if it is a cage, the certificate is filled in with its proof (see
+        # check_certificate); the cache must then start empty.
+        deadline = None if self.timeout is None else monotonic() + self.timeout
+        zone_squares, white_king_square, black_king_square = prepare_board(board, frozen_squares,
+                                                                           additional_zone_squares)
+        key = get_position_key(board)
+        key_variants = get_key_variants(board)
+        if self.database is not None and certificate is None:
+            with self.lock:
+                stored_result = self.database.get_result(key, zone_squares, depth)
+            if stored_result is not None:
+                return stored_result
+
+        if cache is None:
+            cache = self.new_cache()
+        if stats is None and self.stats is not None:
+            stats = SearchStats()
+        with self.lock:
+            self.known_cages.reserve(get_board_units(board), zone_squares)
+        try:
+            result, retraction_sequence = self.search(board, zone_squares, white_king_square, black_king_square, depth,
+                                                      key, key_variants, cache, stats, deadline, certificate)
+        finally:
+            with self.lock:
+                self.known_cages.release()
+        if stats is not None:
+            stats.cache_entries = max(stats.cache_entries, len(cache))
+            stats.cache_evictions += cache.evictions if isinstance(cache, BoundedCache) else 0
+        if self.stats is not None:
+            with self.lock:
+                self.stats.merge(stats)
+        if result is None:
+            return None, []
+        if self.database is not None:
+            with self.lock:
+                self.database.add_result(key, zone_squares, depth, result, retraction_sequence)
+        if result and self.minimize_cages:
+            core = minimize_cage(get_board_units(board), additional_zone_squares, depth, self.known_cages,
+                                 self.engine)
+            cache.clear()
+            cache[get_position_key(get_board_from_units(core)) & key_mask] = depth
+        if result and save:
+            self.save_cages(cache)
+        return result, retraction_sequence
+
+    def search(self, board, zone_squares, white_king_square, black_king_square, depth, key, key_variants, cache,
+               stats, deadline, certificate=None):
+        try:
+            if certificate is not None:
+                search = Search(zone_squares, cache, key_variants, stats=stats, max_nodes=self.max_nodes,
+                                deadline=deadline, cages=self.known_cages, record_proof=True)
+                result = is_cage_internal(board_engines[self.engine](board), white_king_square, black_king_square,
+                                          None, depth, key, search)
+                retraction_sequence = search.retraction_sequence
+                if result:
+                    certificate.update(
+                        position=f'{key & key_mask:x}',
+                        zone=sorted(get_square_string(square) for square in zone_squares), depth=depth,
+                        cages=[f'{get_position_key(get_board_from_units(units)) & key_mask:x}'
+                               for units in search.proof_cages],
+                        proof=''.join(search.proof))
+            else:
+                retraction_sequence, nodes = None, 0
+                if self.iterative_deepening or self.ordering is not None:
+                    escape_depths = range(1, depth) if self.iterative_deepening else [depth]
+                    retraction_sequence, nodes = find_escape(board, self.engine, zone_squares, white_king_square,
+                                                             black_king_square, escape_depths, key, key_variants,
+                                                             stats, self.ordering, self.max_nodes, deadline,
+                                                             self.known_cages)
+                if retraction_sequence is not None:
+                    result = False
+                elif self.workers > 1:
+                    with self.lock:
+                        cage_units = list(self.known_cages.cages)
+                    result, retraction_sequence = is_cage_split(board, self.engine, zone_squares, white_king_square,
+                                                                black_king_square, depth, key, key_variants,
+                                                                self.workers, cache, stats, deadline, self.known_cages,
+                                                                cage_units)
+                else:
+                    search = Search(zone_squares, cache, key_variants, stats=stats,
+                                    max_nodes=None if self.max_nodes is None else self.max_nodes - nodes,
+                                    deadline=deadline, cages=self.known_cages)
+                    result = is_cage_internal(board_engines[self.engine](board), white_king_square,
+                                              black_king_square, None, depth, key, search)
+                    retraction_sequence = search.retraction_sequence
+        except SearchLimitReached:
+            result, retraction_sequence = None, []
+        return result, retraction_sequence
+
+    def save_cages(self, cache, database=True):
+        # Adds the positions proven illegal by a search to the known cages, and to the database if there is one and
+        # database is true, and returns those that were not known yet, without the symmetric images that were added
+        # along with them. The positions proven with the most remaining depth, the verified position and its
+        # symmetric images, are kept in the known cages whatever their limit.
+        new_cages = []
+        root_depth = max(cache.values(), default=None)
+        with self.lock:
+            for cached_key, depth in cache.items():
+                units = get_units_from_key(cached_key)
+                if units not in self.known_cages:
+                    new_cages.append(units)
+                self.known_cages.add(units, None if depth == root_depth else depth)
+            if self.database is not None and database:
+                self.database.add_cages(cache)
+        return new_cages
+
+    def verify(self, forsythe_string, frozen_squares=(), additional_squares=(), depth=20):
+        # The result and retraction sequence of a position given in Forsythe notation, like test_position without
+        # the printing.
+        return self.is_cage(get_board_from_forsythe(forsythe_string), frozen_squares, additional_squares, depth)
+
+    def verify_position(self, position, collect_stats=False, certificate=None):
+        # Returns the result, the retraction sequence, the proven-illegal positions if it is a cage, the statistics
+        # and the time taken, without adding the cages to the known cages. certificate is as for is_cage.
+        forsythe_string, frozen_squares, additional_squares, depth = position
+        cache = self.new_cache()
+        stats = SearchStats() if collect_stats else None
+        start_time = perf_counter()
+        result, retraction_sequence = self.is_cage(get_board_from_forsythe(forsythe_string), frozen_squares,
+                                                   additional_squares, depth, save=False, cache=cache, stats=stats,
+                                                   certificate=certificate)
+        return result, retraction_sequence, cache if result else {}, stats, perf_counter() - start_time
+
+    def load_certificate(self, certificate):
+        # Checks the certificate of a cage against the known cages, and adds the positions it proves illegal to them
+        # as if the cage had been verified, without a search. Returns the cages that were not known yet.
+        return self.save_cages(check_certificate(certificate, self.known_cages, self.engine))
+
+    def screen_position(self, position, collect_stats=False):
+        # Returns what verify_position would for a position that is not a cage because every unit is on a home
+        # square, or is once the units that can be retracted out of the zone are removed, or None if the position
+        # needs a search. The root and the position after the removal are judged with get_node_verdict as in the
+        # search, so the result and the retraction sequence are those of the search, which visits no other position.
+        forsythe_string, frozen_squares, additional_squares, depth = position
+        stats = SearchStats() if collect_stats else None
+        start_time = perf_counter()
+        board = get_board_from_forsythe(forsythe_string)
+        zone_squares, white_king_square, black_king_square = prepare_board(board, frozen_squares, additional_squares)
+        root_key = get_position_key(board)
+        search = Search(zone_squares, {}, get_key_variants(board), stats=stats, cages=self.known_cages)
+        with self.lock:
+            self.known_cages.reserve(get_board_units(board), zone_squares)
+        try:
+            board = board_engines[self.engine](board)
+            verdict, possible_squares = get_node_verdict(board, white_king_square, black_king_square, None, depth,
+                                                         root_key, search)
+            if possible_squares is not None:
+                removed_units, white_king_square, black_king_square, key = \
+                    remove_escaping_units(board, zone_squares, white_king_square, black_king_square,
+                                          board.get_retractions(possible_squares), search.retraction_sequence,
+                                          root_key)
+                if not removed_units:
+                    return None
+                verdict, _ = get_node_verdict(board, white_king_square, black_king_square, None, depth - 1, key,
+                                              search)
+        finally:
+            with self.lock:
+                self.known_cages.release()
+        if verdict is not False:
+            return None
+        return False, search.retraction_sequence, {}, stats, perf_counter() - start_time
+
+
+# The number of positions that the search of each smaller position tried while minimizing a cage may visit.
+minimize_cage_nodes = 20000
+
+
+def minimize_cage(units, additional_zone_squares, depth, cages, engine='list'):
+    # Returns a subset of the units of a cage that is still a cage: each unit in turn is dropped if the position
+    # without it is proven to be a cage, with its own default zone and the additional zone squares, within
+    # minimize_cage_nodes positions. The smaller the core, the more positions contain it, and as a known cage it
+    # stands for all the positions proven illegal in the search of the cage.
+    core = list(units)
+    verifier = CageVerifier(cages, engine, max_nodes=minimize_cage_nodes)
+    for unit in units:
+        candidate = [core_unit for core_unit in core if core_unit != unit]
+        if not candidate:
+            continue
+        board = get_board_from_units((file, rank, color_unit[:2]) for file, rank, color_unit in candidate)
+        frozen_squares = [(file, rank) for file, rank, color_unit in candidate if len(color_unit) > 2 and color_unit[2]]
+        if verifier.is_cage(board, frozen_squares, additional_zone_squares, depth, save=False)[0]:
+            core = candidate
+    return tuple(core)
+
+
+def is_cage(board, frozen_squares, additional_zone_squares, depth, save=True, engine='list', cache=None, workers=1,
+            iterative_deepening=False, database=None, stats=None, ordering=None, max_nodes=None, timeout=None,
+            minimize_cages=False, certificate=None):
+    # CageVerifier.is_cage with the module's known cages.
+    verifier = CageVerifier(known_cages, engine, workers, iterative_deepening, database, ordering, max_nodes, timeout,
+                            minimize_cages=minimize_cages)
+    return verifier.is_cage(board, frozen_squares, additional_zone_squares, depth, save, cache, stats, certificate)
+
 
-    cache = []
-    retraction_sequence = []
-    result = is_cage_internal(board, zone_squares, white_king_square, black_king_square, None,
-                              [], retraction_sequence, depth, cache)
-    if result and save:
-        known_cages.extend(cache)
-    return result, retraction_sequence
+def save_cages(cache, database=None):
+    return CageVerifier(known_cages, database=database).save_cages(cache)
 
 
-def test_position(forsythe_string, frozen_squares, additional_squares, depth):
+def test_position(forsythe_string, frozen_squares, additional_squares, depth, **options):
     board = get_board_from_forsythe(forsythe_string)
     if DEBUG:
         print_board(board)
-    result, retraction_sequence = is_cage(board, frozen_squares, additional_squares, depth)
-    print(f'{forsythe_string} {result} ' +
-          ' '.join([
-              f'{get_square_string(retraction[0])}-{"P" if retraction[2] else ""}{get_square_string(retraction[1])}'
-              for retraction in retraction_sequence]))
+    result, retraction_sequence = is_cage(board, frozen_squares, additional_squares, depth, **options)
+    print(format_result(forsythe_string, result, retraction_sequence))
     return result
 
 
+def format_retraction(retraction):
+    original_square, new_square, unpromote, _, _ = retraction_fields[retraction]
+    return f'{get_square_string(original_square)}-{"P" if unpromote else ""}{get_square_string(new_square)}'
+
+
+def format_result(forsythe_string, result, retraction_sequence):
+    if result is None:
+        return f'{forsythe_string} Unknown'
+    return f'{forsythe_string} {result} ' + ' '.join([format_retraction(retraction)
+                                                      for retraction in retraction_sequence])
+
+
 def parse_square_strings(square_strings):
     match = re.fullmatch('([a-h][1-8])(,[a-h][1-8])*', square_strings)
     if match:
@@ -505,52 +2187,694 @@ def parse_square_strings(square_strings):
         return None
 
 
-if __name__ == "__main__":
-    line_number = 0
-    for line in sys.stdin:
-        line_number += 1
-        raw = line.strip().split()
-        forsythe_string = raw[0]
-        additional_square_strings = []
-        depth = 20
-        frozen_squares = []
-        skip = False
-        for parameter in raw[1:]:
-            parameter_split = parameter.split('=', 1)
-            if len(parameter_split) < 2:
-                print(f'ERROR: Skipping line {line_number} with invalid input {parameter} (expecting key=value)')
-                skip = True
+def parse_input_line(line, line_number):
+    raw = line.strip().split()
+    forsythe_string = raw[0]
+    additional_square_strings = []
+    depth = 20
+    frozen_squares = []
+    for parameter in raw[1:]:
+        parameter_split = parameter.split('=', 1)
+        if len(parameter_split) < 2:
+            raise InvalidInputLineError(f'Skipping line {line_number} with invalid input {parameter} (expecting key=value)')
+        key, value = parameter_split
+        if key.lower() == 'zone':
+            additional_square_strings = parse_square_strings(value)
+            if not additional_square_strings:
+                raise InvalidInputLineError(f'Skipping line {line_number} with invalid zone value {value}')
+        elif key.lower() == 'depth':
+            try:
+                depth = int(value)
+            except ValueError:
+                raise InvalidInputLineError(f'Skipping line {line_number} with invalid depth {value}')
+            if depth < 0:
+                raise InvalidInputLineError(f'Skipping line {line_number} with invalid depth {value}')
+        elif key.lower() == 'frozen':
+            frozen_squares = parse_square_strings(value)
+            if not frozen_squares:
+                raise InvalidInputLineError(f'Skipping line {line_number} with invalid frozen value {value}')
+        else:
+            raise InvalidInputLineError(f'Skipping line {line_number} with invalid key {key} ' +
+                                        '(valid keys are: zone, depth, frozen)')
+    return forsythe_string, frozen_squares, additional_square_strings, depth
+
+
+def parse_input_record(line, line_number):
+    # A JSON Lines input record: {"position": ..., "depth": ..., "frozen": [...], "zone": [...]}, where only the
+    # position is required and the squares are given as strings such as "e1".
+    try:
+        record = json.loads(line)
+    except ValueError:
+        raise InvalidInputLineError(f'Skipping line {line_number} with invalid JSON')
+    return parse_input_object(record, line_number)
+
+
+def parse_input_object(record, line_number):
+    # The position of an input record that has already been decoded from JSON.
+    if not isinstance(record, dict) or not isinstance(record.get('position'), str):
+        raise InvalidInputLineError(f'Skipping line {line_number} without a position')
+    for key in record:
+        if key not in ['position', 'depth', 'frozen', 'zone']:
+            raise InvalidInputLineError(f'Skipping line {line_number} with invalid key {key} ' +
+                                        '(valid keys are: position, zone, depth, frozen)')
+    depth = record.get('depth', 20)
+    if not isinstance(depth, int) or isinstance(depth, bool) or depth < 0:
+        raise InvalidInputLineError(f'Skipping line {line_number} with invalid depth {depth}')
+    squares = {}
+    for key in ['frozen', 'zone']:
+        square_strings = record.get(key, [])
+        if not isinstance(square_strings, list) or \
+                not all(isinstance(square_string, str) for square_string in square_strings):
+            raise InvalidInputLineError(f'Skipping line {line_number} with invalid {key} value {square_strings}')
+        squares[key] = parse_square_strings(','.join(square_strings)) if square_strings else []
+        if squares[key] is None:
+            raise InvalidInputLineError(f'Skipping line {line_number} with invalid {key} value {square_strings}')
+    return record['position'], squares['frozen'], squares['zone'], depth
+
+
+input_parsers = {'text': parse_input_line, 'jsonl': parse_input_record}
+
+
+class TextOutput:
+    # Results in the original format on standard output, each followed by its statistics with show_stats.
+    def __init__(self, show_stats=False):
+        self.collect_stats = show_stats
+
+    def write_result(self, line_number, position, result, retraction_sequence, stats, elapsed_time, new_cages):
+        print(format_result(position[0], result, retraction_sequence), flush=True)
+        if stats is not None:
+            print(stats.format(), flush=True)
+
+    def write_error(self, line_number, message):
+        print(f'ERROR: {message}', flush=True)
+
+
+def get_result_record(position, result, retraction_sequence, stats, elapsed_time):
+    forsythe_string, frozen_squares, additional_squares, depth = position
+    return {'position': forsythe_string, 'frozen': [get_square_string(square) for square in frozen_squares],
+            'zone': [get_square_string(square) for square in additional_squares], 'depth': depth, 'result': result,
+            'retraction_sequence': [format_retraction(retraction) for retraction in retraction_sequence],
+            'nodes': sum(stats.nodes.values()), 'elapsed_time': elapsed_time}
+
+
+class JsonLinesOutput:
+    # One JSON record per input line, written and flushed as soon as the result is known, so that a run can be
+    # resumed from its output. The record of a cage carries, as hex position keys, the known cages it added, so that
+    # a resumed run can rebuild the known cages without searching again.
+    collect_stats = True
+
+    def __init__(self, file):
+        self.file = file
+
+    def write_record(self, record):
+        self.file.write(json.dumps(record) + '\n')
+        self.file.flush()
+
+    def write_result(self, line_number, position, result, retraction_sequence, stats, elapsed_time, new_cages):
+        record = dict(line=line_number, **get_result_record(position, result, retraction_sequence, stats,
+                                                            elapsed_time))
+        if new_cages:
+            record['cages'] = [f'{get_position_key(get_board_from_units(units)) & key_mask:x}'
+                               for units in new_cages]
+        self.write_record(record)
+
+    def write_error(self, line_number, message):
+        self.write_record({'line': line_number, 'error': message})
+
+
+def resume_output(path):
+    # Reads the records of an earlier run from a JSON Lines output file, adds the cages they carry to the known
+    # cages and returns the line numbers already done. A record cut short by a crash is removed from the file.
+    done_line_numbers = set()
+    with open(path, 'r+') as file:
+        good_length = 0
+        for line in iter(file.readline, ''):
+            try:
+                record = json.loads(line)
+            except ValueError:
                 break
-            key, value = parameter_split
-            if key.lower() == 'zone':
-                additional_square_strings = parse_square_strings(value)
-                if not additional_square_strings:
-                    print(f'ERROR: Skipping line {line_number} with invalid zone value {value}')
-                    skip = True
-                    break
-            elif key.lower() == 'depth':
-                try:
-                    depth = int(value)
-                except ValueError:
-                    print(f'ERROR: Skipping line {line_number} with invalid depth {value}')
-                    skip = True
-                    break
-                if depth < 0:
-                    print(f'ERROR: Skipping line {line_number} with invalid depth {value}')
-                    skip = True
-                    break
-            elif key.lower() == 'frozen':
-                frozen_squares = parse_square_strings(value)
-                if not frozen_squares:
-                    print(f'ERROR: Skipping line {line_number} with invalid frozen value {value}')
-                    skip = True
+            if not line.endswith('\n'):
+                break
+            good_length = file.tell()
+            done_line_numbers.add(record['line'])
+            for position in record.get('cages', []):
+                known_cages.add(get_units_from_key(int(position, 16)))
+        file.truncate(good_length)
+    return done_line_numbers
+
+
+def format_memory_report(cages):
+    # The peak resident set sizes of this process and of its largest worker process, and the size of the known cages.
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    worker_peak_rss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    kept_cages = sum(1 for depth in cages.cages.values() if depth is None)
+    return (f'memory: peak RSS {peak_rss} KiB' + (f', workers {worker_peak_rss} KiB' if worker_peak_rss else '') +
+            f'; known cages {len(cages)} ({kept_cages} always kept), {cages.evictions} evicted')
+
+
+# Squares of a position encoded by encode_forsythe, and the number of input lines read and screened at a time.
+forsythe_expansion = str.maketrans({str(length): EMPTY * length for length in range(1, 9)})
+prescreen_chunk_size = 1000
+
+
+def encode_forsythe(forsythe_string):
+    # The 64 squares of a position as characters, from a8 to h8 down to a1 to h1, with EMPTY for an empty square, or
+    # None if the Forsythe notation is not eight ranks of eight valid squares.
+    ranks = forsythe_string.strip().translate(forsythe_expansion).split('/')
+    if len(ranks) != 8 or any(len(rank) != 8 or rank.strip('KQRBNPkqrbnp' + EMPTY) for rank in ranks):
+        return None
+    return ''.join(ranks)
+
+
+def shift_squares(squares, vector, distance):
+    # squares[:, file, rank] moved so that each square holds the value of the square distance times vector away
+    # from it, or False if that is off the board.
+    file_offset, rank_offset = vector[0] * distance, vector[1] * distance
+    shifted = numpy.zeros_like(squares)
+    shifted[:, max(-file_offset, 0):8 - max(file_offset, 0), max(-rank_offset, 0):8 - max(rank_offset, 0)] = \
+        squares[:, max(file_offset, 0):8 + min(file_offset, 0), max(rank_offset, 0):8 + min(rank_offset, 0)]
+    return shifted
+
+
+def get_escape_candidates(positions):
+    # For each position, or InvalidInputLineError in its place, whether CageVerifier.screen_position may resolve it:
+    # every unit is on a home square or is a knight, bishop, rook or queen that can be retracted out of the zone in
+    # one move. Kings, pawns and unpromoted units can only be retracted to adjacent squares, which are in the zone.
+    # With NumPy, the positions are tested all at once on arrays of their squares, without building their boards;
+    # without it, every valid position is a candidate. The test only decides which positions are screened, so it
+    # cannot change a result.
+    if numpy is None:
+        return [not isinstance(position, Exception) for position in positions]
+    encoded_positions = [None if isinstance(position, Exception) else encode_forsythe(position[0])
+                         for position in positions]
+    valid = numpy.array([encoded_position is not None for encoded_position in encoded_positions], dtype=bool)
+    rows = numpy.frombuffer(''.join(encoded_position or EMPTY * 64 for encoded_position in encoded_positions)
+                            .encode('ascii'), dtype=numpy.uint8).reshape(-1, 8, 8)
+    boards = rows[:, ::-1, :].transpose(0, 2, 1)  # [position, file, rank]
+    occupied = boards != ord(EMPTY)
+    zone = occupied.copy()
+    for vector in queen_vectors:
+        zone |= shift_squares(occupied, vector, 1)
+    for index, encoded_position in enumerate(encoded_positions):
+        if encoded_position is not None:
+            for file, rank in positions[index][2]:
+                zone[index, file, rank] = True
+    outside = ~zone
+    empty = ~occupied
+
+    knight_escapes = numpy.zeros_like(outside)
+    for vector in knight_vectors:
+        knight_escapes |= shift_squares(outside, vector, 1)
+    line_escapes = {}
+    for vector in queen_vectors:
+        escapes = numpy.zeros_like(outside)
+        open_ray = numpy.ones_like(outside)
+        for distance in range(1, 8):
+            escapes |= open_ray & shift_squares(outside, vector, distance)
+            open_ray &= shift_squares(empty, vector, distance)
+        line_escapes[vector] = escapes
+    rook_escapes = numpy.logical_or.reduce([line_escapes[vector] for vector in rook_vectors])
+    bishop_escapes = numpy.logical_or.reduce([line_escapes[vector] for vector in bishop_vectors])
+
+    def is_unit(units):
+        return numpy.isin(boards, [ord(character) for unit in units for character in (unit, unit.lower())])
+
+    home_squares = numpy.zeros((256, 8, 8), dtype=bool)
+    home_squares[ord(EMPTY)] = True
+    for (color, unit), squares in original_squares.items():
+        for file, rank in squares:
+            home_squares[ord(unit if color == WHITE else unit.lower()), file, rank] = True
+    home = home_squares[boards, numpy.arange(8)[:, None], numpy.arange(8)[None, :]]
+    escaping = (is_unit([KNIGHT]) & knight_escapes) | (is_unit([ROOK, QUEEN]) & rook_escapes) | \
+        (is_unit([BISHOP, QUEEN]) & bishop_escapes)
+    return (valid & (home | escaping).all(axis=(1, 2))).tolist()
+
+
+def read_positions(lines, input_format, done_line_numbers=(), prescreen=False):
+    # Yields the line number of each input line not done yet, its position or the InvalidInputLineError raised
+    # parsing it, and whether it is to be screened. With prescreen, the lines are read and the candidates for the
+    # screen found prescreen_chunk_size lines at a time.
+    parse = input_parsers[input_format]
+    numbered_lines = ((line_number, line) for line_number, line in enumerate(lines, 1)
+                      if line_number not in done_line_numbers)
+    while True:
+        chunk = list(islice(numbered_lines, prescreen_chunk_size if prescreen else 1))
+        if not chunk:
+            return
+        positions = []
+        for line_number, line in chunk:
+            try:
+                positions.append(parse(line, line_number))
+            except InvalidInputLineError as e:
+                positions.append(e)
+        candidates = get_escape_candidates(positions) if prescreen else [False] * len(positions)
+        yield from zip([line_number for line_number, _ in chunk], positions, candidates)
+
+
+def verify_position(position, options, collect_stats):
+    return CageVerifier(known_cages, **options).verify_position(position, collect_stats)
+
+
+def run_serial(lines, options, output=None, input_format='text', done_line_numbers=(), prescreen=False,
+               certificates=None):
+    # With certificates, a file, the certificate of each cage verified is written to it as a line of JSON.
+    output = output or TextOutput()
+    verifier = CageVerifier(known_cages, **options)
+    for line_number, position, candidate in read_positions(lines, input_format, done_line_numbers, prescreen):
+        if isinstance(position, Exception):
+            output.write_error(line_number, str(position))
+            continue
+        certificate = None if certificates is None else {}
+        try:
+            screened_result = verifier.screen_position(position, output.collect_stats) if candidate else None
+            result, retraction_sequence, proven_cages, stats, elapsed_time = \
+                screened_result or verifier.verify_position(position, output.collect_stats, certificate)
+        except (ForsytheNotationError, InvalidFrozenSquareError) as e:
+            output.write_error(line_number, f'Skipping line {line_number} because: {e}')
+            continue
+        if certificate:
+            certificates.write(json.dumps(certificate) + '\n')
+            certificates.flush()
+        new_cages = verifier.save_cages(proven_cages)
+        output.write_result(line_number, position, result, retraction_sequence, stats, elapsed_time, new_cages)
+
+
+# Known cages of a batch worker process, as the number of cage batches from the parent applied so far. Each batch
+# is the cache of a committed cage, and is saved as the parent saved it, so that a worker with the parent's limit on
+# known cages evicts the cages that the parent evicted.
+worker_cage_generation = 0
+
+
+def initialize_batch_worker(cages, max_cages=None):
+    global worker_cage_generation
+    known_cages.clear()
+    known_cages.max_cages = max_cages
+    for units, depth in cages:
+        known_cages.add(units, depth)
+    worker_cage_generation = 0
+
+
+def verify_batch_position(position, options, first_generation, cage_batches, collect_stats):
+    global worker_cage_generation
+    for generation, cage_batch in enumerate(cage_batches, first_generation):
+        if generation == worker_cage_generation:
+            save_cages(cage_batch)
+            worker_cage_generation += 1
+    return (os.getpid(), worker_cage_generation) + verify_position(position, options, collect_stats)
+
+
+def get_batch_database_entry(position):
+    forsythe_string, frozen_squares, additional_squares, depth = position
+    board = get_board_from_forsythe(forsythe_string)
+    zone_squares, _, _ = prepare_board(board, frozen_squares, additional_squares)
+    return get_position_key(board), zone_squares, depth
+
+
+def run_batch(lines, jobs, options, output=None, input_format='text', done_line_numbers=(), prescreen=False):
+    # Positions are verified speculatively in a process pool against the known cages committed so far, and committed
+    # in input order. Whenever a committed cage adds new known cages, they are sent to the workers as a new batch,
+    # and any position that was verified against an older set of known cages is verified again, so every result
+    # is the one the serial run would give. With prescreen, the candidates for the screen are screened when they
+    # are committed instead, and only sent to the workers if the screen does not resolve them. An ordering that
+    # learns would learn from different positions in each worker, so it cannot be used.
+    if options.get('ordering') is not None and options['ordering'].learns:
+        raise ValueError('An ordering that learns cannot be combined with more than one job')
+    output = output or TextOutput()
+    positions = []
+    candidates = []
+    for line_number, position, candidate in read_positions(lines, input_format, done_line_numbers, prescreen):
+        positions.append((line_number, position))
+        candidates.append(candidate)
+    # Results and cages are only read from and written to the database here, in input order, as in a serial run.
+    database = options.get('database')
+    worker_options = {option: value for option, value in options.items() if option != 'database'}
+    cage_batches = []
+    worker_generations = {}
+    screen_verifier = CageVerifier(known_cages, **worker_options)
+
+    with ProcessPoolExecutor(jobs, initializer=initialize_batch_worker,
+                             initargs=(list(known_cages.items()), known_cages.max_cages)) as executor:
+        def submit(position):
+            first_generation = min(worker_generations.values()) if len(worker_generations) == jobs else 0
+            return executor.submit(verify_batch_position, position, worker_options, first_generation,
+                                   cage_batches[first_generation:], output.collect_stats)
+
+        futures = [None if isinstance(position, Exception) or candidate else submit(position)
+                   for (_, position), candidate in zip(positions, candidates)]
+        for index, (line_number, position) in enumerate(positions):
+            if isinstance(position, Exception):
+                output.write_error(line_number, str(position))
+                continue
+            try:
+                stored_result = None
+                if database is not None:
+                    database_entry = get_batch_database_entry(position)
+                    stored_result = database.get_result(*database_entry)
+                screened_result = None
+                if stored_result is None and candidates[index]:
+                    screened_result = screen_verifier.screen_position(position, output.collect_stats)
+                    if screened_result is None:
+                        futures[index] = submit(position)
+                if stored_result is not None:
+                    if futures[index] is not None:
+                        futures[index].cancel()
+                    (result, retraction_sequence), proven_cages = stored_result, {}
+                    stats, elapsed_time = SearchStats() if output.collect_stats else None, 0.0
+                elif screened_result is not None:
+                    result, retraction_sequence, proven_cages, stats, elapsed_time = screened_result
+                else:
+                    while True:
+                        pid, generation, result, retraction_sequence, proven_cages, stats, elapsed_time = \
+                            futures[index].result()
+                        worker_generations[pid] = generation
+                        if generation == len(cage_batches):
+                            break
+                        futures[index] = submit(position)
+            except (ForsytheNotationError, InvalidFrozenSquareError) as e:
+                output.write_error(line_number, f'Skipping line {line_number} because: {e}')
+                continue
+            if database is not None and stored_result is None and result is not None:
+                database.add_result(*database_entry, result, retraction_sequence)
+            new_cages = save_cages(proven_cages, database if stored_result is None else None)
+            output.write_result(line_number, position, result, retraction_sequence, stats, elapsed_time, new_cages)
+            if new_cages:
+                cage_batches.append(proven_cages)
+                for later_index in range(index + 1, len(positions)):
+                    if futures[later_index] is not None and futures[later_index].cancel():
+                        futures[later_index] = submit(positions[later_index][1])
+
+
+# The squares that an uncastling moves a king or a rook to, which need not be in the zone.
+uncastling_squares = {(file, rank) for file in [0, 4, 7] for rank in [0, 7]}
+
+
+def get_unit_counts(units):
+    counts = {}
+    for _, _, color_unit in units:
+        counts[color_unit[:2]] = counts.get(color_unit[:2], 0) + 1
+    return counts
+
+
+def may_reach_cage(units, zone_squares, cage_units):
+    # False if no position reached by the search of a position with these units and zone can contain the cage: the
+    # units stay on the squares of the zone, or those an uncastling puts them on, retractions never add a piece, and
+    # they only add a pawn by unpromoting a piece of its color.
+    for file, rank, _ in cage_units:
+        if (file, rank) not in zone_squares and (file, rank) not in uncastling_squares:
+            return False
+    counts = get_unit_counts(units)
+    for (color, unit), count in get_unit_counts(cage_units).items():
+        available = counts.get((color, unit), 0)
+        if unit == PAWN:
+            available += sum(counts.get((color, piece), 0) for piece in [QUEEN, ROOK, BISHOP, KNIGHT])
+        if count > available:
+            return False
+    return True
+
+
+def get_escape_boards(units, zone_squares, retraction_sequence):
+    # Yields the board of the position and then the board after each retraction of the sequence of a failed search,
+    # as one board that changes between them. A retraction out of the zone is the removal of the unit, as in
+    # remove_escaping_units.
+    board = get_board_from_units(units)
+    yield board
+    for retraction in retraction_sequence:
+        original_square, new_square, _, _, uncastle = retraction_fields[retraction]
+        if not uncastle and new_square not in zone_squares:
+            board[original_square[0]][original_square[1]] = (EMPTY, EMPTY)
+        else:
+            do_retraction(board, None, None, retraction, 0)
+        yield board
+
+
+def escapes_home(units, zone_squares, retraction_sequence):
+    # Whether the retraction sequence of a failed search leads to a position with every unit on a home square, rather
+    # than to the maximum depth. A search with the same known cages then fails too: the positions it proves illegal
+    # would have to include every position of the sequence, the last one as well, since none of them contains a
+    # known cage.
+    for board in get_escape_boards(units, zone_squares, retraction_sequence):
+        pass
+    return in_home_squares(board, [(file, rank) for file in range(8) for rank in range(8)])
+
+
+def get_containment_schedule(entries):
+    # Returns the indices of the entries, each the units of a position, in the order they are to be verified: the
+    # input order, except that each position comes after the positions contained in it, that is, those whose units,
+    # or a symmetric image of them, are a proper subset of its own, so that a cage among them is known by the time
+    # the larger position is searched. The images are filed under one of their units as in KnownCages.
+    index = {}
+    for entry_index, units in enumerate(entries):
+        for symmetric_units in get_symmetric_units(units):
+            if not symmetric_units:
+                continue
+            anchor = min(symmetric_units, key=lambda unit: len(index.get(unit, ())))
+            index.setdefault(anchor, []).append((frozenset(symmetric_units), entry_index))
+
+    def get_contained(entry_index):
+        units = frozenset(entries[entry_index])
+        return iter(sorted({other_index for unit in units for other_units, other_index in index.get(unit, ())
+                            if other_units < units}))
+
+    schedule = []
+    visited = [False] * len(entries)
+    for first_index in range(len(entries)):
+        if visited[first_index]:
+            continue
+        visited[first_index] = True
+        stack = [(first_index, get_contained(first_index))]
+        while stack:
+            entry_index, contained = stack[-1]
+            for other_index in contained:
+                if not visited[other_index]:
+                    visited[other_index] = True
+                    stack.append((other_index, get_contained(other_index)))
                     break
             else:
-                print(f'ERROR: Skipping line {line_number} with invalid key {key} (valid keys are: zone, depth, frozen)')
-                skip = True
-        if skip:
+                stack.pop()
+                schedule.append(entry_index)
+    return schedule
+
+
+def run_scheduled(lines, options, output=None, input_format='text', done_line_numbers=(), prescreen=False):
+    # Verifies the positions in an order that makes the most of the known cages, and writes the results in input
+    # order once all of them are known. A position given again with the same zone and depth is verified only once.
+    # The positions are verified in the order of get_containment_schedule, and then each position that was not
+    # verified as a cage is verified again if a cage that its search may reach (see may_reach_cage) was added to
+    # the known cages after its last search, until no such cage is added. A position whose escape leads all the way
+    # home is only verified again if one of the positions of its escape contains one of the new cages, since its
+    # search fails with them otherwise, as with the same known cages (see escapes_home). Returns the counters of the
+    # schedule: known_cage_hits are those of the searches reported, and gained_known_cage_hits those on cages from
+    # positions later in the input, which a run in input order would not have known yet.
+    output = output or TextOutput()
+    database = options.get('database')
+    verifier = CageVerifier(known_cages, **{option: value for option, value in options.items()
+                                            if option != 'database'})
+    report = {'positions': 0, 'duplicates': 0, 'moved': 0, 'retries': 0, 'proven_on_retry': 0, 'known_cage_hits': 0,
+              'gained_known_cage_hits': 0}
+    # Each line is (line number, error message, None) or (line number, position, entry index), and each entry
+    # (position, units, zone squares, database entry, whether it is to be screened).
+    numbered_lines = []
+    entries = []
+    entry_indices = {}
+    for line_number, position, candidate in read_positions(lines, input_format, done_line_numbers, prescreen):
+        if isinstance(position, Exception):
+            numbered_lines.append((line_number, str(position), None))
             continue
+        forsythe_string, frozen_squares, additional_squares, depth = position
         try:
-            test_position(forsythe_string, frozen_squares, additional_square_strings, depth)
+            board = get_board_from_forsythe(forsythe_string)
+            zone_squares, _, _ = prepare_board(board, frozen_squares, additional_squares)
         except (ForsytheNotationError, InvalidFrozenSquareError) as e:
-            print(f'ERROR: Skipping line {line_number} because: {e}')
+            numbered_lines.append((line_number, f'Skipping line {line_number} because: {e}', None))
+            continue
+        key = get_position_key(board)
+        entry_key = (key & key_mask, get_zone_string(zone_squares), depth)
+        if entry_key in entry_indices:
+            report['duplicates'] += 1
+        else:
+            entry_indices[entry_key] = len(entries)
+            entries.append((position, get_board_units(board), zone_squares, (key, zone_squares, depth), candidate))
+        numbered_lines.append((line_number, position, entry_indices[entry_key]))
+
+    # The result, retraction sequence, statistics, time and new cages of each entry, whether it may be verified
+    # again, the known cages added so far with their symmetric images, the number of them already checked with
+    # may_reach_cage for each entry, and the entry each of them was added by.
+    results = [None] * len(entries)
+    retriable = [False] * len(entries)
+    added_cages = []
+    checked_cages = [0] * len(entries)
+    cage_origins = {}
+
+    def verify(entry_index, retry):
+        position, _, _, database_entry, candidate = entries[entry_index]
+        stored_result = None if database is None or retry else database.get_result(*database_entry)
+        if stored_result is not None:
+            (result, retraction_sequence), proven_cages, stats, elapsed_time = stored_result, {}, SearchStats(), 0.0
+        else:
+            screened_result = verifier.screen_position(position, True) if candidate and not retry else None
+            result, retraction_sequence, proven_cages, stats, elapsed_time = \
+                screened_result or verifier.verify_position(position, True)
+            if database is not None and result is not None:
+                database.add_result(*database_entry, result, retraction_sequence)
+        new_cages = save_cages(proven_cages, database if stored_result is None else None)
+        for cage_units in new_cages:
+            for symmetric_units in get_symmetric_units(cage_units):
+                if symmetric_units not in cage_origins:
+                    cage_origins[symmetric_units] = entry_index
+                    added_cages.append(symmetric_units)
+        checked_cages[entry_index] = len(added_cages)
+        results[entry_index] = result, retraction_sequence, stats, elapsed_time, new_cages
+        retriable[entry_index] = result is not True
+
+    schedule = get_containment_schedule([entry[1] for entry in entries])
+    first_unverified = 0
+    for entry_index in schedule:
+        if entry_index > first_unverified:
+            report['moved'] += 1
+        verify(entry_index, False)
+        while first_unverified < len(entries) and results[first_unverified] is not None:
+            first_unverified += 1
+    retrying = True
+    while retrying:
+        retrying = False
+        for entry_index in schedule:
+            if not retriable[entry_index]:
+                continue
+            _, units, zone_squares, _, _ = entries[entry_index]
+            new_cages = added_cages[checked_cages[entry_index]:]
+            checked_cages[entry_index] = len(added_cages)
+            reachable_cages = KnownCages()
+            for cage_units in new_cages:
+                if may_reach_cage(units, zone_squares, cage_units):
+                    reachable_cages.add(cage_units)
+            if not reachable_cages:
+                continue
+            result, retraction_sequence, _, _, _ = results[entry_index]
+            if result is False and escapes_home(units, zone_squares, retraction_sequence) and \
+                    not any(reachable_cages.find(board) for board in get_escape_boards(units, zone_squares,
+                                                                                         retraction_sequence)):
+                continue
+            report['retries'] += 1
+            verify(entry_index, True)
+            if results[entry_index][0] is True:
+                report['proven_on_retry'] += 1
+            retrying = True
+
+    for entry_index, (_, _, stats, _, _) in enumerate(results):
+        for cage_units, hits in stats.known_cage_matches.items():
+            report['known_cage_hits'] += hits
+            if cage_origins.get(cage_units, -1) > entry_index:
+                report['gained_known_cage_hits'] += hits
+    reported_entries = set()
+    for line_number, position, entry_index in numbered_lines:
+        if entry_index is None:
+            output.write_error(line_number, position)
+            continue
+        report['positions'] += 1
+        result, retraction_sequence, stats, elapsed_time, new_cages = results[entry_index]
+        if entry_index in reported_entries:
+            stats, elapsed_time, new_cages = SearchStats(), 0.0, []
+        reported_entries.add(entry_index)
+        output.write_result(line_number, position, result, retraction_sequence,
+                            stats if output.collect_stats else None, elapsed_time, new_cages)
+    return report
+
+
+def format_schedule_report(report):
+    return (f"schedule: {report['positions']} positions, {report['duplicates']} duplicates verified once, "
+            f"{report['moved']} verified ahead of their input order, {report['retries']} verified again "
+            f"({report['proven_on_retry']} proven), {report['known_cage_hits']} known cage hits "
+            f"({report['gained_known_cage_hits']} gained by the schedule)")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Verify cages read one per line from standard input.')
+    parser.add_argument('--jobs', type=int, default=1,
+                        help='number of worker processes used to verify positions in parallel (default: 1)')
+    parser.add_argument('--iterative-deepening', action='store_true',
+                        help='search for an escape to increasing depths first and report the shortest one found')
+    parser.add_argument('--database', metavar='PATH',
+                        help='SQLite file of results and known cages shared between runs; created if it does not exist')
+    parser.add_argument('--ordering', choices=list(retraction_orderings),
+                        help='first search for an escape home, trying retractions as generated, toward home squares '
+                             'first, or by the history of earlier escapes; escapes may be reported differently')
+    parser.add_argument('--stats', action='store_true',
+                        help='print node counts, cutoffs and time spent in the search after each result')
+    parser.add_argument('--minimize-cages', action='store_true',
+                        help='learn each proven cage as a smaller core that is still a cage instead of as every '
+                             'position proven illegal in its search')
+    parser.add_argument('--max-nodes', type=int, metavar='N',
+                        help='give up on a position, reporting it as Unknown, after searching this many positions')
+    parser.add_argument('--timeout', type=float, metavar='SECONDS',
+                        help='give up on a position, reporting it as Unknown, after searching it for this long')
+    parser.add_argument('--max-cache-entries', type=int, metavar='N',
+                        help='keep at most this many positions of the cache of each search in memory, and the '
+                             'others in a temporary file')
+    parser.add_argument('--cache-policy', choices=cache_policies, default='depth',
+                        help='positions evicted first from a full cache: those proven at the least remaining depth '
+                             '(the default) or the least recently used')
+    parser.add_argument('--max-known-cages', type=int, metavar='N',
+                        help='keep at most this many known cages in memory, and the others, those proven at the '
+                             'least remaining depth, in a temporary file')
+    parser.add_argument('--prescreen', action='store_true',
+                        help='resolve the positions that are not cages because their units are home, or are once the '
+                             'units that can leave the zone are removed, without a search; the candidates are found '
+                             'with NumPy if it is installed')
+    parser.add_argument('--schedule', action='store_true',
+                        help='verify each position after the positions contained in it and verify failed positions '
+                             'again when new cages may help, printing the results in input order at the end')
+    parser.add_argument('--certificates', metavar='PATH',
+                        help='write the certificate of each cage verified to this file, one JSON object per line')
+    parser.add_argument('--load-certificates', metavar='PATH',
+                        help='check the certificates in this file, in order, and add the cages they prove to the '
+                             'known cages without searching them')
+    parser.add_argument('--input-format', choices=list(input_parsers), default='text',
+                        help='format of the input lines: the key=value text format (the default) or JSON Lines')
+    parser.add_argument('--jsonl', metavar='PATH',
+                        help='write one JSON record per input line to this file instead of text to standard output')
+    parser.add_argument('--resume', action='store_true',
+                        help='skip the input lines already recorded in the --jsonl file and append to it')
+    args = parser.parse_args()
+    if args.resume and not args.jsonl:
+        parser.error('--resume requires --jsonl')
+    if args.schedule and args.jobs > 1:
+        parser.error('--schedule cannot be combined with --jobs')
+    if args.ordering == 'history' and args.jobs > 1:
+        parser.error('--ordering history cannot be combined with --jobs')
+    if args.certificates and (args.jobs > 1 or args.schedule or args.minimize_cages):
+        parser.error('--certificates cannot be combined with --jobs, --schedule or --minimize-cages')
+    search_options = {'iterative_deepening': args.iterative_deepening, 'max_nodes': args.max_nodes,
+                      'timeout': args.timeout, 'minimize_cages': args.minimize_cages,
+                      'max_cache_entries': args.max_cache_entries, 'cache_policy': args.cache_policy}
+    if args.ordering:
+        search_options['ordering'] = retraction_orderings[args.ordering]()
+    known_cages.max_cages = args.max_known_cages
+    if args.database:
+        search_options['database'] = CageDatabase(args.database)
+        search_options['database'].load_cages(known_cages)
+    if args.load_certificates:
+        certificate_verifier = CageVerifier(known_cages, database=search_options.get('database'))
+        with open(args.load_certificates) as certificate_file:
+            for line_number, line in enumerate(certificate_file, 1):
+                try:
+                    certificate_verifier.load_certificate(json.loads(line))
+                except ValueError as e:
+                    parser.error(f'Certificate on line {line_number} of {args.load_certificates} is not valid: {e}')
+    done_line_numbers = set()
+    if args.jsonl:
+        if args.resume and os.path.exists(args.jsonl):
+            done_line_numbers = resume_output(args.jsonl)
+        output = JsonLinesOutput(open(args.jsonl, 'a' if args.resume else 'w'))
+    else:
+        output = TextOutput(args.stats)
+    if args.schedule:
+        print(format_schedule_report(run_scheduled(sys.stdin, search_options, output, args.input_format,
+                                                   done_line_numbers, args.prescreen)), flush=True)
+    elif args.jobs > 1:
+        run_batch(list(sys.stdin), args.jobs, search_options, output, args.input_format, done_line_numbers,
+                  args.prescreen)
+    else:
+        run_serial(sys.stdin, search_options, output, args.input_format, done_line_numbers, args.prescreen,
+                   open(args.certificates, 'w') if args.certificates else None)
+    if args.stats:
+        print(format_memory_report(known_cages), flush=True)
@@ -1,5 +1,17 @@
+import asyncio
+import http.client
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
 import unittest
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from copy import deepcopy
 from cages import *
+from cage_server import CageServer
 
 
 test_cages_data = [
@@ -56,7 +68,29 @@ test_non_cages_data = [
 ]
 
 
+# Positions of white pawns with a few units among and behind them, drawn at random as in benchmarks.py and
+# searched at depth 8, on which the search options must give the verdicts of a plain search. Some are cages, and
+# the first ones gave different verdicts with some option before.
+generated_positions = [
+    '8/8/8/8/8/P1PPP3/P1PPP3/4k3', '8/8/8/8/1P6/P1PP4/PPPP4/K7', '8/8/8/8/6P1/6P1/4NPPP/6k1',
+    '8/8/8/8/8/4P3/3PPPR1/3K4', '8/4P3/1K6/8/2pp4/p7/8/8', '8/8/8/8/1PP5/P2PP3/1P1P4/1R1b4',
+    '8/8/8/8/7P/5PPP/4PkP1/8', '8/8/8/8/4P1P1/4P1P1/3P1PP1/4R1B1', '8/8/8/8/8/4PPPP/4P1BP/4K3',
+    '8/8/8/8/5P2/4PPP1/3P1PPP/5NN1', '8/8/8/8/3P4/3PP1P1/3K1PPP/8', '8/8/8/8/P2P4/PBPP4/P1Pn4/Q1q5',
+    '8/8/8/8/8/PP1P4/P1PPP3/1k6', '8/8/8/8/2P5/2PP4/1KPPP3/8', '8/8/8/8/8/6PP/5PPP/4R1KQ',
+    '8/8/8/8/3P3P/3P3P/4PP1P/7k', '8/8/8/8/5P2/2PKPP2/2P3P1/8', '8/8/8/8/P7/1P1P4/KP6/B2Q4',
+    '8/8/8/8/3P4/2P1P3/2PPPP2/1Q6', '8/8/8/8/8/4P1P1/2P3q1/3r1q2', '8/8/8/8/2P1P3/1PP2P2/1PP1N3/8',
+    '8/8/8/8/4P3/1P6/1PP1P3/R7', '8/8/8/8/2P2P2/4P3/1R1P4/1k6', '8/8/8/8/3P4/1P1N4/P1Pk4/3K4',
+    '8/8/8/8/P2P4/3P4/4P3/1N2K3', '8/8/8/8/8/4P3/3K1PP1/3Qb3', '8/8/8/8/5P2/2QP4/kPP1Kr2/8'
+]
+
+
 class TestCages(unittest.TestCase):
+    engine = 'list'
+
+    @classmethod
+    def setUpClass(cls):
+        known_cages.clear()
+
     def test_cages(self):
         print('Testing cages')
         for data in test_cages_data:
@@ -65,7 +99,7 @@ class TestCages(unittest.TestCase):
                 self.assertEqual(test_position(position,
                                                [get_square(sq) for sq in frozen_squares_strings],
                                                [get_square(sq) for sq in additional_zone_squares_strings],
-                                               depth), True)
+                                               depth, engine=self.engine), True)
 
     def test_non_cages(self):
         print('Testing non cages')
@@ -75,4 +109,633 @@ class TestCages(unittest.TestCase):
                 self.assertEqual(test_position(position,
                                                [get_square(sq) for sq in frozen_squares_strings],
                                                [get_square(sq) for sq in additional_zone_squares_strings],
-                                               depth), False)
+                                               depth, engine=self.engine), False)
+
+
+class TestBitboardCages(TestCages):
+    engine = 'bitboard'
+
+
+class TestIterativeDeepening(unittest.TestCase):
+    def test_verdicts(self):
+        known_cages.clear()
+        for data in test_cages_data + test_non_cages_data:
+            with self.subTest(data=data):
+                position, frozen_squares_strings, additional_zone_squares_strings, depth = data
+                result, _ = is_cage(get_board_from_forsythe(position), [get_square(sq) for sq in frozen_squares_strings],
+                                    [get_square(sq) for sq in additional_zone_squares_strings], depth,
+                                    iterative_deepening=True)
+                self.assertEqual(result, data in test_cages_data)
+
+    def test_shortest_escape(self):
+        result, retraction_sequence = is_cage(get_board_from_forsythe('8/8/8/8/8/8/PPPPPPPP/2B1RK2'), [], [], 10,
+                                              iterative_deepening=True)
+        self.assertEqual(result, False)
+        self.assertEqual(len(retraction_sequence), 3)
+
+    def test_loop_proofs_not_reused(self):
+        # Positions proven through loop cutoffs in one iteration must not be reused in the next.
+        known_cages.clear()
+        board = get_board_from_forsythe('6b1/8/3R4/8/1B6/8/r2P4/3P4')
+        self.assertEqual(is_cage(deepcopy(board), [], [], 8)[0], False)
+        self.assertEqual(is_cage(board, [], [], 8, iterative_deepening=True)[0], False)
+
+    def test_matches_plain_search(self):
+        plain_verifier = CageVerifier()
+        iterative_verifier = CageVerifier(iterative_deepening=True)
+        for position in generated_positions:
+            with self.subTest(position=position):
+                self.assertEqual(iterative_verifier.verify(position, depth=8)[0],
+                                 plain_verifier.verify(position, depth=8)[0])
+
+
+class TestRetractionOrdering(unittest.TestCase):
+    def test_verdicts(self):
+        for name, ordering_class in retraction_orderings.items():
+            known_cages.clear()
+            ordering = ordering_class()
+            for data in test_cages_data + test_non_cages_data:
+                with self.subTest(ordering=name, data=data):
+                    position, frozen_squares_strings, additional_zone_squares_strings, depth = data
+                    result, _ = is_cage(get_board_from_forsythe(position),
+                                        [get_square(sq) for sq in frozen_squares_strings],
+                                        [get_square(sq) for sq in additional_zone_squares_strings], depth,
+                                        ordering=ordering)
+                    self.assertEqual(result, data in test_cages_data)
+
+    def test_matches_plain_search(self):
+        plain_verifier = CageVerifier()
+        for name, ordering_class in retraction_orderings.items():
+            verifier = CageVerifier(ordering=ordering_class())
+            for position in generated_positions:
+                with self.subTest(ordering=name, position=position):
+                    self.assertEqual(verifier.verify(position, depth=8)[0], plain_verifier.verify(position, depth=8)[0])
+
+
+class TestMinimizeCages(unittest.TestCase):
+    def test_verdicts(self):
+        known_cages.clear()
+        for data in test_cages_data + test_non_cages_data:
+            with self.subTest(data=data):
+                position, frozen_squares_strings, additional_zone_squares_strings, depth = data
+                result, _ = is_cage(get_board_from_forsythe(position), [get_square(sq) for sq in frozen_squares_strings],
+                                    [get_square(sq) for sq in additional_zone_squares_strings], depth,
+                                    minimize_cages=True)
+                self.assertEqual(result, data in test_cages_data)
+
+    def test_core(self):
+        core = minimize_cage(get_board_units(get_board_from_forsythe('7K/pppp1ppp/4p3/8/8/8/8/8')), [], 20,
+                             KnownCages())
+        self.assertEqual(get_board_from_units(core), get_board_from_forsythe('7K/1pp2pp1/8/8/8/8/8/8'))
+        cache = {}
+        self.assertEqual(is_cage(get_board_from_forsythe('7K/pppp1ppp/4p3/8/8/8/8/8'), [], [], 20, save=False,
+                                 cache=cache, minimize_cages=True), (True, []))
+        self.assertEqual(list(cache), [get_position_key(get_board_from_units(core)) & key_mask])
+
+
+class TestMemoryCaps(unittest.TestCase):
+    def test_verdicts(self):
+        for cache_policy in cache_policies:
+            verifier = CageVerifier(KnownCages(max_cages=16), max_cache_entries=8, cache_policy=cache_policy)
+            for data in test_cages_data + test_non_cages_data:
+                with self.subTest(cache_policy=cache_policy, data=data):
+                    position, frozen_squares_strings, additional_zone_squares_strings, depth = data
+                    result, _ = verifier.verify(position, [get_square(sq) for sq in frozen_squares_strings],
+                                                [get_square(sq) for sq in additional_zone_squares_strings], depth)
+                    self.assertEqual(result, data in test_cages_data)
+            self.assertGreater(verifier.known_cages.evictions, 0)
+
+    def test_bounded_cache(self):
+        cache = BoundedCache(4)
+        cache.update({1: 5, 2: 1, 3: 4, 4: 2})
+        cache[5] = 3
+        self.assertEqual(cache, {1: 5, 3: 4, 5: 3})
+        self.assertEqual(cache.evictions, 2)
+        self.assertEqual(dict(cache.items()), {1: 5, 2: 1, 3: 4, 4: 2, 5: 3})
+        self.assertIn(2, cache)
+        self.assertEqual(cache[4], 2)
+        self.assertNotIn(6, cache)
+        self.assertEqual(dict(cache.items()), {1: 5, 2: 1, 3: 4, 4: 2, 5: 3})
+        cache = BoundedCache(4, 'lru')
+        cache.update({1: 5, 2: 1, 3: 4, 4: 2})
+        self.assertIn(1, cache)
+        cache[5] = 3
+        self.assertEqual(list(cache), [4, 1, 5])
+
+    def test_evicted_positions_are_learned(self):
+        # The later positions need a cage learned from the first, some of whose positions are evicted from the cache.
+        lines = ['8/4PR2/2b5/8/8/8/1n6/2P5 depth=8', '6P1/8/8/7B/6P1/8/b7/1n3P2 depth=8',
+                 '8/2P5/b2P4/8/8/1nr5/8/2P4R depth=8']
+        for cache_policy in cache_policies:
+            verifier = CageVerifier(KnownCages(), max_cache_entries=4, cache_policy=cache_policy)
+            for line_number, line in enumerate(lines, 1):
+                with self.subTest(cache_policy=cache_policy, line=line):
+                    self.assertEqual(verifier.verify(*parse_input_line(line, line_number)), (True, []))
+
+    def test_matches_unbounded_search(self):
+        verifier = CageVerifier()
+        bounded_verifier = CageVerifier(KnownCages(max_cages=8), max_cache_entries=8)
+        for position in generated_positions:
+            with self.subTest(position=position):
+                self.assertEqual(bounded_verifier.verify(position, depth=8)[0], verifier.verify(position, depth=8)[0])
+        self.assertGreater(bounded_verifier.known_cages.evictions, 0)
+
+    def test_evicted_cages_are_used(self):
+        # The second position is only proven with a cage learned from the first, which is evicted in between.
+        cages = KnownCages(max_cages=4)
+        verifier = CageVerifier(cages)
+        self.assertEqual(verifier.verify('8/8/8/8/8/2P5/1PPPR3/2q1R3', depth=10)[0], True)
+        self.assertEqual(CageVerifier().verify('8/8/8/8/5P2/4PP2/2PNPPP1/5K2', depth=10)[0], False)
+        self.assertEqual(verifier.verify('8/8/8/8/5P2/4PP2/2PNPPP1/5K2', depth=10)[0], True)
+        self.assertGreater(cages.evictions, 0)
+
+    def test_verified_positions_are_kept(self):
+        cages = KnownCages(max_cages=4)
+        verifier = CageVerifier(cages)
+        self.assertEqual(verifier.verify('8/8/8/8/8/8/PPkPP3/KR1b4', depth=5), (True, []))
+        self.assertIn(get_board_units(get_board_from_forsythe('8/8/8/8/8/8/PPkPP3/KR1b4')), cages)
+        self.assertLessEqual(len(cages), 4)
+        self.assertGreater(cages.evictions, 0)
+
+
+# Positions with every unit home, with a knight that can leave the zone, with a pawn that cannot, and with a
+# checking knight that can leave it, and whether the screen resolves each.
+screen_data = [('rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR', True), ('8/8/8/8/3N4/8/8/4K3', True),
+               ('8/8/8/8/4P3/8/8/4K3', False), ('8/8/8/8/8/5n2/8/4K3', True)]
+
+
+class TestPrescreen(unittest.TestCase):
+    def get_positions(self):
+        return [(position, [get_square(sq) for sq in frozen_squares_strings],
+                 [get_square(sq) for sq in additional_zone_squares_strings], depth)
+                for (position, frozen_squares_strings, additional_zone_squares_strings, depth)
+                in test_cages_data + test_non_cages_data] + [(position, [], [], 20) for position, _ in screen_data]
+
+    def test_screen_matches_search(self):
+        known_cages.clear()
+        verifier = CageVerifier(known_cages)
+        for position in self.get_positions():
+            with self.subTest(position=position):
+                screened_result = verifier.screen_position(position)
+                result = verifier.verify_position(position)
+                verifier.save_cages(result[2])
+                if screened_result is not None:
+                    self.assertEqual(screened_result[:3], result[:3])
+        for position, screened in screen_data:
+            with self.subTest(position=position):
+                self.assertEqual(CageVerifier().screen_position((position, [], [], 20)) is not None, screened)
+
+    @unittest.skipUnless(numpy, 'NumPy is not installed')
+    def test_escape_candidates(self):
+        positions = self.get_positions() + [InvalidInputLineError('no position'), ('8/8/8', [], [], 20)]
+        candidates = get_escape_candidates(positions)
+        self.assertEqual(candidates[-2:], [False, False])
+        for position, candidate in zip(positions[:-2], candidates):
+            with self.subTest(position=position):
+                board = get_board_from_forsythe(position[0])
+                zone_squares, _, _ = prepare_board(board, position[1], position[2])
+                self.assertEqual(candidate, all(
+                    square in original_squares[board[square[0]][square[1]][:2]] or
+                    any(new_square not in zone_squares and not unpromote
+                        for _, new_square, unpromote, _, _
+                        in map(unpack_retraction, get_retractions_from_square(board, square)))
+                    for square in zone_squares if board[square[0]][square[1]][1] != EMPTY))
+                if CageVerifier().screen_position(position) is not None:
+                    self.assertTrue(candidate)
+
+    def test_prescreen_matches_search(self):
+        input_text = '\n'.join(get_input_lines(test_cages_data + test_non_cages_data) +
+                               [f'{position} depth=20' for position, _ in screen_data] +
+                               ['8/8/8/8/8/8/PPPPPPPP/2B1RK2 depth=x', '8/8/8/8/8/8/8/K7 frozen=a1']) + '\n'
+        expected_output = run_cages_script([], input_text)
+        self.assertEqual(run_cages_script(['--prescreen'], input_text), expected_output)
+        self.assertEqual(run_cages_script(['--prescreen', '--jobs', '2'], input_text), expected_output)
+
+
+class TestSearchStats(unittest.TestCase):
+    def test_counts(self):
+        known_cages.clear()
+        stats = SearchStats()
+        result, _ = is_cage(get_board_from_forsythe('8/8/8/8/8/8/PPPPPPPP/2B1RK2'), [], [], 10, save=False,
+                            stats=stats)
+        self.assertEqual(result, False)
+        self.assertEqual(stats.nodes[10], 1)
+        self.assertEqual(sum(stats.nodes.values()), 25)
+        self.assertEqual(stats.loop_cutoffs, 12)
+        self.assertEqual(stats.cache_hits, 3)
+
+        split_stats = SearchStats()
+        result, _ = is_cage(get_board_from_forsythe('7K/pppp1ppp/4p3/8/8/8/8/8'), [], [], 20, save=False,
+                            workers=2, stats=split_stats)
+        self.assertEqual(result, True)
+        self.assertEqual(split_stats.nodes[20], 1)
+        self.assertGreater(split_stats.loop_cutoffs, 0)
+
+
+class TestSearchLimits(unittest.TestCase):
+    def test_node_limit(self):
+        known_cages.clear()
+        cache = {}
+        stats = SearchStats()
+        board_string = '7K/pppp1ppp/4p3/8/8/8/8/8'
+        result, _ = is_cage(get_board_from_forsythe(board_string), [], [], 20, cache=cache, max_nodes=20, stats=stats)
+        self.assertIsNone(result)
+        self.assertEqual(sum(stats.nodes.values()), 20)
+        self.assertEqual(len(known_cages), 0)
+        self.assertTrue(cache)
+        result, _ = is_cage(get_board_from_forsythe(board_string), [], [], 20, cache=cache)
+        self.assertEqual(result, True)
+
+    def test_timeout(self):
+        known_cages.clear()
+        for workers in [1, 2]:
+            with self.subTest(workers=workers):
+                self.assertEqual(is_cage(get_board_from_forsythe('7K/pppp1ppp/4p3/8/8/8/8/8'), [], [], 20,
+                                         workers=workers, timeout=0), (None, []))
+
+
+class TestDeepSearch(unittest.TestCase):
+    def test_search_is_not_recursive(self):
+        # The search path of this cage reaches several hundred retractions.
+        known_cages.clear()
+        recursion_limit = sys.getrecursionlimit()
+        sys.setrecursionlimit(100)
+        try:
+            result, _ = is_cage(get_board_from_forsythe('nK1k4/r1ppRpp1/pp2p3/8/8/8/8/8'), [], [], 1000, save=False)
+        finally:
+            sys.setrecursionlimit(recursion_limit)
+        self.assertEqual(result, True)
+
+
+class TestCageDatabase(unittest.TestCase):
+    def test_results_and_cages_persist(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'cages.db')
+            database = CageDatabase(path)
+            known_cages.clear()
+            for position in ['8/8/8/8/8/8/PPkPP3/KR1b4', '8/8/8/8/8/8/PPPPPPPP/2B1RK2']:
+                is_cage(get_board_from_forsythe(position), [], [], 10, database=database)
+            database.close()
+
+            database = CageDatabase(path)
+            cages = KnownCages()
+            database.load_cages(cages)
+            self.assertEqual(len(cages), len(known_cages))
+            self.assertIsNotNone(cages.find(get_board_from_forsythe('8/8/8/8/8/8/PPkPP3/KR1b4')))
+            board = get_board_from_forsythe('8/8/8/8/8/8/PPPPPPPP/2B1RK2')
+            zone_squares, _, _ = prepare_board(board, [], [])
+            self.assertIsNone(database.get_result(get_position_key(board), zone_squares, 10))
+            board = get_board_from_forsythe('8/8/8/8/8/8/PPkPP3/KR1b4')
+            zone_squares, _, _ = prepare_board(board, [], [])
+            self.assertEqual(database.get_result(get_position_key(board), zone_squares, 10), (True, []))
+            self.assertIsNone(database.get_result(get_position_key(board), zone_squares, 5))
+            database.close()
+
+    def test_failures_verified_again(self):
+        # A position that was not verified is searched again, with the cages that are known by then.
+        with tempfile.TemporaryDirectory() as directory:
+            database = CageDatabase(os.path.join(directory, 'cages.db'))
+            verifier = CageVerifier(KnownCages(), database=database)
+            position = '8/8/8/8/1P6/kP6/BrPP4/K7'
+            self.assertEqual(verifier.verify(position, depth=10)[0], False)
+            for cage in ['8/8/8/8/8/2P5/1PPP4/8', '8/8/8/8/8/8/P1P5/1B6', '8/8/8/8/8/1PP5/B1PP4/8']:
+                self.assertEqual(verifier.verify(cage), (True, []))
+            self.assertEqual(verifier.verify(position, depth=10), (True, []))
+            database.close()
+
+
+class TestPositionKeys(unittest.TestCase):
+    def test_incremental_keys(self):
+        for position in ['2kr4/pppppppp/8/8/8/8/PPPPPPPP/5RK1', 'k1r2b2/pppppppp/8/8/8/8/8/8', '4BQ1q/3ppKpk/7p/8/8/8/8/8']:
+            with self.subTest(position=position):
+                board = get_board_from_forsythe(position)
+                key = get_position_key(board)
+                squares = [(file, rank) for file in range(8) for rank in range(8)]
+                for retraction in get_retractions(board, squares):
+                    board, _, _, _, new_key = do_retraction(board, None, None, retraction, key)
+                    self.assertEqual(new_key, get_position_key(board))
+                    board, _, _, new_key = undo_retraction(board, None, None, retraction, new_key)
+                    self.assertEqual(new_key, key)
+
+
+class TestKnownCages(unittest.TestCase):
+    def test_find_matches_contains_cage(self):
+        cages = [get_board_from_forsythe(data[0]) for data in test_cages_data]
+        index = KnownCages()
+        for cage in cages[::2]:
+            index.add(get_board_units(cage))
+        boards = [get_board_from_forsythe(data[0]) for data in test_cages_data + test_non_cages_data]
+        for board in boards[:]:
+            extended_board = deepcopy(board)
+            file, rank = next(square for square in [(file, rank) for file in range(8) for rank in range(8)]
+                              if board[square[0]][square[1]][1] == EMPTY)
+            extended_board[file][rank] = (BLACK, KNIGHT)
+            boards.append(extended_board)
+        for board in boards:
+            with self.subTest(board=board):
+                self.assertEqual(index.find(board) is not None,
+                                 any(contains_cage(board, get_board_from_units(units)) for cage in cages[::2]
+                                     for units in get_symmetric_units(get_board_units(cage))))
+
+
+class TestSymmetry(unittest.TestCase):
+    def setUp(self):
+        known_cages.clear()
+
+    def tearDown(self):
+        known_cages.clear()
+
+    def test_symmetric_images(self):
+        # A cage without kings or queens, its mirror image, and its image under the color flip.
+        images = ['6b1/5pp1/6p1/8/8/8/8/8', '1b6/1pp5/1p6/8/8/8/8/8', '8/8/8/8/8/6P1/5PP1/6B1']
+        for forsythe_string in images:
+            with self.subTest(forsythe_string=forsythe_string):
+                known_cages.clear()
+                self.assertTrue(is_cage(get_board_from_forsythe(forsythe_string), [], [], 5, save=False)[0])
+        self.assertTrue(is_cage(get_board_from_forsythe(images[0]), [], [], 5)[0])
+        for forsythe_string in images[1:]:
+            with self.subTest(forsythe_string=forsythe_string):
+                self.assertIsNotNone(known_cages.find(get_board_from_forsythe(forsythe_string)))
+
+    def test_kings_are_not_mirrored(self):
+        self.assertTrue(is_cage(get_board_from_forsythe('8/8/8/8/8/8/PPkPP3/KR1b4'), [], [], 5)[0])
+        self.assertIsNotNone(known_cages.find(get_board_from_forsythe('kr1B4/ppKpp3/8/8/8/8/8/8')))
+        self.assertIsNone(known_cages.find(get_board_from_forsythe('8/8/8/8/8/8/3PPkPP/4b1RK')))
+
+
+class TestBitBoard(unittest.TestCase):
+    def test_matches_list_board(self):
+        squares = [(file, rank) for file in range(8) for rank in range(8)]
+        for data in test_cages_data + test_non_cages_data + [('2kr4/pppppppp/8/8/8/8/PPPPPPPP/5RK1', [], [], 0)]:
+            with self.subTest(data=data):
+                board = ListBoard(get_board_from_forsythe(data[0]))
+                bitboard = BitBoard(board)
+                for square in squares:
+                    self.assertEqual(bitboard.get_retractions_from_square(square),
+                                     get_retractions_from_square(board, square))
+                    if board[square[0]][square[1]][1] == KING:
+                        self.assertEqual(sorted(bitboard.get_unblockable_checkers(square)),
+                                         sorted(board.get_unblockable_checkers(square)))
+                self.assertEqual(bitboard.in_home_squares(squares), board.in_home_squares(squares))
+                for retraction in board.get_retractions(squares):
+                    bitboard.do_retraction(None, None, retraction, 0)
+                    board.do_retraction(None, None, retraction, 0)
+                    self.assertEqual(bitboard.files, board)
+                    bitboard.undo_retraction(None, None, retraction, 0)
+                    board.undo_retraction(None, None, retraction, 0)
+                    self.assertEqual(bitboard.files, board)
+
+
+def get_input_lines(data):
+    return [f'{position} depth={depth}' + (f' frozen={",".join(frozen_squares_strings)}' if frozen_squares_strings else '') +
+            (f' zone={",".join(additional_zone_squares_strings)}' if additional_zone_squares_strings else '')
+            for position, frozen_squares_strings, additional_zone_squares_strings, depth in data]
+
+
+def run_cages_script(arguments, input_text):
+    return subprocess.run([sys.executable, 'cages.py'] + arguments, input=input_text, capture_output=True, text=True,
+                          cwd=os.path.dirname(os.path.abspath(__file__)), check=True).stdout
+
+
+class TestCageVerifier(unittest.TestCase):
+    def test_sessions_are_independent(self):
+        known_cages.clear()
+        verifier = CageVerifier()
+        other_verifier = CageVerifier()
+        self.assertEqual(verifier.verify('8/8/8/8/8/8/PPkPP3/KR1b4', depth=5), (True, []))
+        self.assertTrue(verifier.known_cages)
+        self.assertEqual(len(other_verifier.known_cages), 0)
+        self.assertEqual(len(known_cages), 0)
+
+    def test_threads(self):
+        # A cage proven by one thread can help another prove its cage, so a position whose verdict depends on the
+        # cages proven before it may have either verdict, and every other position must have the verdict of a
+        # serial run in the same order. A position that is not a cage is never proven.
+        data = [(position, [get_square(sq) for sq in frozen_squares_strings],
+                 [get_square(sq) for sq in additional_zone_squares_strings], depth)
+                for (position, frozen_squares_strings, additional_zone_squares_strings, depth)
+                in test_cages_data + test_non_cages_data]
+        serial_verifier = CageVerifier()
+        serial_results = [serial_verifier.verify(*position)[0] for position in data]
+        unaided_results = [CageVerifier().verify(*position)[0] for position in data]
+        verifier = CageVerifier(collect_stats=True)
+        with ThreadPoolExecutor(4) as executor:
+            results = list(executor.map(lambda position: verifier.verify(*position)[0], data))
+        for position, serial_result, unaided_result, result in zip(data, serial_results, unaided_results, results):
+            with self.subTest(position=position[0]):
+                if unaided_result == serial_result:
+                    self.assertEqual(result, serial_result)
+                else:
+                    self.assertIn(result, (unaided_result, serial_result))
+        self.assertEqual(serial_results, [True] * len(test_cages_data) + [False] * len(test_non_cages_data))
+        self.assertEqual(results[len(test_cages_data):], [False] * len(test_non_cages_data))
+        self.assertTrue(verifier.stats.nodes)
+
+
+class TestBatch(unittest.TestCase):
+    def test_parallel_batch_matches_serial(self):
+        input_text = '\n'.join(get_input_lines(test_cages_data + test_non_cages_data) +
+                               ['8/8/8/8/8/8/PPPPPPPP/2B1RK2 depth=x', '8/8/8/8/8/8/8/K7 frozen=a1']) + '\n'
+        self.assertEqual(run_cages_script(['--jobs', '3'], input_text), run_cages_script([], input_text))
+
+    def test_learning_ordering_rejected(self):
+        # Each worker would learn from different positions than the serial run.
+        with self.assertRaises(ValueError):
+            run_batch([], 2, {'ordering': HistoryOrdering()})
+        with self.assertRaises(ValueError):
+            CageServer(2, ordering=HistoryOrdering())
+        run_batch([], 2, {'ordering': HomeSquaresOrdering()})
+
+
+class TestSchedule(unittest.TestCase):
+    def test_containment_schedule(self):
+        # The larger position comes after the smaller one contained in it, here as its image with the colors flipped.
+        entries = [get_board_units(get_board_from_forsythe(position)) for position in
+                   ['8/7p/8/8/8/8/PPkPP3/KR1b4', '8/8/8/8/8/8/4K3/8', 'kr1B4/ppKpp3/8/8/8/8/8/8']]
+        self.assertEqual(get_containment_schedule(entries), [2, 0, 1])
+
+    def test_reversed_input(self):
+        # In reverse order, the auxiliary cages come after the cages that need them, which are then only proven when
+        # they are verified again. The results are still printed in input order.
+        data = test_cages_data[::-1] + test_non_cages_data
+        input_text = '\n'.join(get_input_lines(data) + ['8/8/8/8/8/8/PPPPPPPP/2B1RK2 depth=x']) + '\n'
+        self.assertIn(' False', run_cages_script([], input_text))
+        output_lines = run_cages_script(['--schedule'], input_text).splitlines()
+        self.assertEqual([line.split()[:2] for line in output_lines[:len(data)]],
+                         [[position, str(index < len(test_cages_data))]
+                          for index, (position, _, _, _) in enumerate(data)])
+        self.assertTrue(output_lines[len(data)].startswith('ERROR: '))
+        self.assertRegex(output_lines[-1], r'^schedule: 40 positions, 1 duplicates verified once, .*, '
+                                           r'[1-9]\d* verified again \([1-9]\d* proven\), .*\([1-9]\d* gained')
+
+
+class TestCertificates(unittest.TestCase):
+    def get_certificates(self):
+        verifier = CageVerifier(KnownCages())
+        certificates = []
+        for (position, frozen_squares_strings, additional_zone_squares_strings, depth) in test_cages_data:
+            certificate = {}
+            result, _, cache, _, _ = verifier.verify_position(
+                (position, [get_square(sq) for sq in frozen_squares_strings],
+                 [get_square(sq) for sq in additional_zone_squares_strings], depth), certificate=certificate)
+            self.assertTrue(result)
+            verifier.save_cages(cache)
+            certificates.append(json.loads(json.dumps(certificate)))
+        return certificates, verifier.known_cages
+
+    def test_load_certificates(self):
+        certificates, cages = self.get_certificates()
+        self.assertTrue(any(certificate['cages'] for certificate in certificates))
+        verifier = CageVerifier(KnownCages())
+        for certificate in certificates:
+            verifier.load_certificate(certificate)
+        self.assertEqual(verifier.known_cages.cages.keys(), cages.cages.keys())
+
+    def test_invalid_certificates(self):
+        certificates, cages = self.get_certificates()
+        certificate = certificates[0]
+        cited_certificate = next(certificate for certificate in certificates if certificate['cages'])
+        for invalid_certificate, invalid_cages in [
+                (dict(certificate, proof=certificate['proof'].replace('X', 'C', 1)), cages),
+                (dict(certificate, proof=certificate['proof'][:-1]), cages),
+                (dict(certificate, proof=certificate['proof'] + 'X'), cages),
+                (dict(certificate, proof=certificate['proof'].replace('A', 'R', 1)), cages),
+                (dict(certificate, depth=1), cages),
+                (dict(certificate, position='zz'), cages),
+                (cited_certificate, KnownCages())]:
+            with self.subTest(certificate=invalid_certificate):
+                with self.assertRaises(InvalidCertificateError):
+                    check_certificate(invalid_certificate, invalid_cages)
+
+    def test_malformed_certificates(self):
+        certificates, cages = self.get_certificates()
+        certificate = certificates[0]
+        for invalid_certificate in [dict(certificate, depth='5'), dict(certificate, depth=-1),
+                                    dict(certificate, depth=True), dict(certificate, zone=['a']),
+                                    dict(certificate, zone=['a9']), dict(certificate, zone='a1'),
+                                    dict(certificate, position='1f'), dict(certificate, position=f'{1 << 320:x}'),
+                                    dict(certificate, position=5), dict(certificate, cages=['1f']),
+                                    dict(certificate, cages='1'), dict(certificate, proof=5),
+                                    dict(certificate, proof=certificate['proof'] + 'Z'),
+                                    {key: value for key, value in certificate.items() if key != 'depth'}, [], 'x']:
+            with self.subTest(certificate=invalid_certificate):
+                with self.assertRaises(InvalidCertificateError):
+                    check_certificate(invalid_certificate, cages)
+
+    def test_command_line(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'certificates.jsonl')
+            input_text = '\n'.join(get_input_lines(test_cages_data + test_non_cages_data)) + '\n'
+            expected_output = run_cages_script(['--certificates', path], input_text)
+            with open(path) as file:
+                self.assertEqual(len(file.readlines()), len(test_cages_data))
+            self.assertEqual(run_cages_script(['--load-certificates', path], input_text), expected_output)
+
+
+class TestCageServer(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever)
+        self.thread.start()
+        self.server = CageServer(jobs=2)
+        http_server = self.run_coroutine(self.server.start('127.0.0.1', 0))
+        self.url = f'http://127.0.0.1:{http_server.sockets[0].getsockname()[1]}'
+
+    def tearDown(self):
+        self.run_coroutine(self.server.stop())
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+
+    def run_coroutine(self, coroutine):
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
+
+    def post(self, request):
+        with urllib.request.urlopen(urllib.request.Request(f'{self.url}/verify', json.dumps(request).encode(),
+                                                           method='POST')) as response:
+            return json.loads(response.read())
+
+    def test_batch_matches_serial(self):
+        records = [{'position': position, 'frozen': frozen_squares_strings, 'zone': additional_zone_squares_strings,
+                    'depth': depth}
+                   for (position, frozen_squares_strings, additional_zone_squares_strings, depth)
+                   in test_cages_data + test_non_cages_data]
+        results = self.post(records + [{'position': 'x'}])
+        self.assertEqual([result['result'] for result in results[:-1]],
+                         [True] * len(test_cages_data) + [False] * len(test_non_cages_data))
+        self.assertIn('error', results[-1])
+        self.assertEqual(self.post(records[0]), results[0])
+
+    def test_invalid_content_length(self):
+        host, port = self.url.split('/')[-1].split(':')
+        for content_length in ['x', '-1']:
+            with self.subTest(content_length=content_length):
+                connection = http.client.HTTPConnection(host, int(port))
+                connection.putrequest('POST', '/verify')
+                connection.putheader('Content-Length', content_length)
+                connection.endheaders()
+                response = connection.getresponse()
+                self.assertEqual(response.status, 400)
+                self.assertEqual(json.loads(response.read()), {'error': 'Invalid Content-Length'})
+                connection.close()
+
+    def test_concurrent_requests_share_a_search(self):
+        async def verify_twice():
+            position = ('8/8/8/8/8/8/PPkPP3/KR1b4', [], [], 5)
+            return await asyncio.gather(self.server.verify(position), self.server.verify(position))
+
+        first_result, second_result = self.run_coroutine(verify_twice())
+        self.assertEqual(first_result, second_result)
+        self.assertEqual(self.server.get_stats()['searches'], 1)
+        self.assertEqual(self.server.get_stats()['deduplicated'], 1)
+
+    def test_failures_verified_again(self):
+        # A position that was not verified is proven once a later request adds its auxiliary cages.
+        position = {'position': '8/8/8/8/1P6/kP6/BrPP4/K7', 'depth': 10}
+        self.assertEqual(self.post(position)['result'], False)
+        self.post([{'position': cage} for cage in ['8/8/8/8/8/2P5/1PPP4/8', '8/8/8/8/8/8/P1P5/1B6',
+                                                    '8/8/8/8/8/1PP5/B1PP4/8']])
+        self.assertEqual(self.post(position)['result'], True)
+        self.assertEqual(self.server.get_stats()['results'], 4)
+
+
+class TestJsonLines(unittest.TestCase):
+    def get_records(self, path):
+        with open(path) as file:
+            return [{key: value for key, value in json.loads(line).items() if key != 'elapsed_time'} for line in file]
+
+    def test_resume_matches_full_run(self):
+        input_lines = get_input_lines(test_cages_data + test_non_cages_data) + ['8/8/8/8/8/8/8/K7 frozen=a1']
+        with tempfile.TemporaryDirectory() as directory:
+            full_path = os.path.join(directory, 'full.jsonl')
+            resumed_path = os.path.join(directory, 'resumed.jsonl')
+            run_cages_script(['--jsonl', full_path], '\n'.join(input_lines) + '\n')
+            run_cages_script(['--jsonl', resumed_path], '\n'.join(input_lines[:20]) + '\n')
+            with open(resumed_path, 'a') as file:
+                file.write('{"line": 21, "posi')
+            run_cages_script(['--jsonl', resumed_path, '--resume'], '\n'.join(input_lines) + '\n')
+            self.assertEqual(self.get_records(resumed_path), self.get_records(full_path))
+            self.assertEqual(len(self.get_records(full_path)), len(input_lines))
+
+
+class TestRootSplit(unittest.TestCase):
+    def test_split_verdicts(self):
+        known_cages.clear()
+        for data in test_cages_data + test_non_cages_data:
+            with self.subTest(data=data):
+                position, frozen_squares_strings, additional_zone_squares_strings, depth = data
+                result, _ = is_cage(get_board_from_forsythe(position), [get_square(sq) for sq in frozen_squares_strings],
+                                    [get_square(sq) for sq in additional_zone_squares_strings], depth, workers=2)
+                self.assertEqual(result, data in test_cages_data)
+
+    def test_split_matches_serial(self):
+        serial_verifier = CageVerifier()
+        split_verifier = CageVerifier(workers=2)
+        for position in generated_positions:
+            with self.subTest(position=position):
+                self.assertEqual(split_verifier.verify(position, depth=8)[0],
+                                 serial_verifier.verify(position, depth=8)[0])
+
+    def test_split_with_bounded_cache(self):
+        verifier = CageVerifier(workers=2, max_cache_entries=50)
+        self.assertEqual(verifier.verify('7K/pppp1ppp/4p3/8/8/8/8/8', depth=20), (True, []))